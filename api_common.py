@@ -0,0 +1,123 @@
+import os
+import re
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import embeddings_service
+from search_response import SEARCH_RESPONSE_TOKEN_BUDGET, SEARCH_RESPONSE_MIN_TOKEN_BUDGET
+
+load_dotenv()
+
+# Общие настройки и разбор запросов API для синхронного (server.py) и асинхронного (async_server.py) серверов
+API_KEY = os.getenv('GPTS_API_KEY')
+# Владелец заметок для ключа GPTS_API_KEY; ключи остальных владельцев хранятся в коллекции api_keys
+DEFAULT_OWNER_ID = os.getenv('DEFAULT_OWNER_ID', '_5e1e01c1b9373143f359de4bd060d2fd')
+SERVER_KEY = os.getenv('SERVER_KEY')
+# Период полураспада веса свежести заметок при поиске (в днях), 0 отключает переранжирование
+SEARCH_RECENCY_HALF_LIFE_DAYS = float(os.getenv('SEARCH_RECENCY_HALF_LIFE_DAYS', '0'))
+# Максимальная длина поискового запроса в токенах
+SEARCH_QUERY_MAX_TOKENS = 8192
+
+# HTML шаблон для страницы ввода кода
+AUTH_PAGE_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>iCloud Authentication</title>
+</head>
+<body>
+    <h2>Enter iCloud Verification Code for {{ account }}</h2>
+    <form action="/submit_code" method="post">
+        <input type="text" name="code" placeholder="Enter verification code">
+        <input type="hidden" name="key" value="{{ key }}">
+        <input type="hidden" name="account" value="{{ account }}">
+        <input type="submit" value="Submit">
+    </form>
+</body>
+</html>
+"""
+
+
+def bearer_api_key(auth_header):
+    """Ключ API из заголовка Authorization: Bearer <ключ>."""
+    auth_header = auth_header or ''
+    return auth_header[len('Bearer '):] if auth_header.startswith('Bearer ') else None
+
+
+def parse_date_param(value):
+    """
+    Преобразует дату из запроса (ISO 8601 или метка времени в мс) в метку времени в мс.
+    Дата без часового пояса считается датой в UTC, а не в поясе сервера.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def wants_stream(data, accept_header):
+    """Клиент просит потоковый ответ полем stream или заголовком Accept: application/x-ndjson."""
+    return bool(data.get('stream')) or 'application/x-ndjson' in (accept_header or '')
+
+
+def parse_search_request(data):
+    """
+    Разбирает тело запроса /search.
+
+    :return: (параметры поиска, None) или (None, текст ошибки для ответа 400)
+    """
+    # Проверяем, что поле search_text присутствует в запросе
+    if not data or 'search_query' not in data:
+        return None, 'Missing search_text parameter'
+
+    query_text = data['search_query']
+    num_tokens = embeddings_service.num_tokens_from_string(query_text)
+
+    # Если текст длиннее, чем 8192 токена, обрезаем его
+    if num_tokens > SEARCH_QUERY_MAX_TOKENS:
+        query_text = embeddings_service.truncate_text(query_text, SEARCH_QUERY_MAX_TOKENS)
+
+    # Необязательные фильтры по папке и дате изменения, а также вес свежести
+    try:
+        edited_after = parse_date_param(data.get('edited_after'))
+        edited_before = parse_date_param(data.get('edited_before'))
+        recency_half_life_days = float(data.get('recency_half_life_days', SEARCH_RECENCY_HALF_LIFE_DAYS))
+    except (TypeError, ValueError) as e:
+        return None, f'Invalid filter parameter: {e}'
+    if recency_half_life_days < 0:
+        return None, 'Invalid recency_half_life_days parameter: must not be negative'
+
+    # Ответ укладывается в бюджет токенов: дубликаты отбрасываются, из длинных чанков берутся релевантные фрагменты.
+    # Клиент может попросить ответ короче, но не длиннее SEARCH_RESPONSE_TOKEN_BUDGET
+    # и не короче SEARCH_RESPONSE_MIN_TOKEN_BUDGET
+    try:
+        token_budget = int(data['max_response_tokens']) if 'max_response_tokens' in data else None
+    except (TypeError, ValueError):
+        return None, 'Invalid max_response_tokens parameter'
+    if token_budget is not None:
+        if token_budget <= 0:
+            return None, 'Invalid max_response_tokens parameter: must be positive'
+        token_budget = min(max(token_budget, SEARCH_RESPONSE_MIN_TOKEN_BUDGET), SEARCH_RESPONSE_TOKEN_BUDGET)
+
+    return {
+        'query_text': query_text,
+        'folder_id': data.get('folder_id'),
+        'folder_name': data.get('folder_name'),
+        'edited_after': edited_after,
+        'edited_before': edited_before,
+        'recency_half_life_days': recency_half_life_days,
+        'token_budget': token_budget
+    }, None
+
+
+def search_response_header():
+    return f"""Below is a list of notes found for different dates. Newer ones are more important, and information in older notes from more than a month ago may already be outdated. Current date is {datetime.now().strftime('%d %B %Y, %H:%M')}. Use these notes to craft the most helpful response to the query. If the question was about the present or future make sure to clarify that this is how you noted it earlier. \n\n"""
+
+
+def extract_invite_guid(url):
+    """GUID приглашения в общую папку — последний сегмент ссылки iCloud."""
+    guid = re.search(r'([a-zA-Z0-9]+)$', url)
+    return guid.group(1) if guid else None
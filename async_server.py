@@ -0,0 +1,213 @@
+from quart import Quart, request, jsonify, abort, send_file, render_template_string, Response, g
+import embeddings_service
+from search_response import build_search_response, iter_ndjson_search_response
+from hybrid_search import search_notes_async
+from db_service import DatabaseService
+from dotenv import load_dotenv
+from functools import wraps
+import os
+import asyncio
+import logging
+import time
+from sync_worker import SyncWorkerPool
+from notes_reader import ICLOUD_ACCOUNT_PASSWORDS, DEFAULT_ICLOUD_ACCOUNT
+from auth_broker import auth_broker
+from tenants import TenantRegistry
+from api_common import (API_KEY, DEFAULT_OWNER_ID, SERVER_KEY, AUTH_PAGE_TEMPLATE, bearer_api_key,
+                        wants_stream, parse_search_request, search_response_header, extract_invite_guid)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Асинхронный сервер API: те же эндпоинты и ключи, что у server.py, но поиск ждёт OpenAI и MongoDB
+# в цикле событий, поэтому число одновременных поисков не ограничено числом потоков.
+# Синхронизацию он не выполняет (роль web): задачи из очереди выполняет server.py с SERVER_ROLE=sync
+load_dotenv()
+LAZY_STARTUP = os.getenv('LAZY_STARTUP', 'false').lower() == 'true'
+WARM_UP_RETRY_SECONDS = float(os.getenv('WARM_UP_RETRY_SECONDS', '5'))
+ASYNC_SERVER_BIND = os.getenv('ASYNC_SERVER_BIND', '0.0.0.0:8080')
+
+app = Quart(__name__)
+# Синхронный клиент нужен только для прогрева индексов, постановки задач и кода 2FA; их вызовы идут через
+# asyncio.to_thread. Поиск и проверка ключей работают через асинхронный клиент
+db_service = DatabaseService(lazy=True)
+auth_broker.attach(db_service)
+tenant_registry = TenantRegistry(db_service, API_KEY, DEFAULT_OWNER_ID)
+sync_workers = SyncWorkerPool(db_service)
+
+warm_up_done = asyncio.Event()
+
+async def warm_up():
+    """Индексы MongoDB и соединения обоих клиентов, кодировщик tiktoken, соединение с OpenAI."""
+    started_at = time.monotonic()
+    if not db_service.ready:
+        await asyncio.to_thread(db_service.warm_up)
+    await db_service.warm_up_async()
+    await embeddings_service.warm_up_async()
+    warm_up_done.set()
+    logger.info(f"Warm-up completed in {time.monotonic() - started_at:.2f}s")
+
+async def warm_up_in_background():
+    while not warm_up_done.is_set():
+        try:
+            await warm_up()
+        except Exception as e:
+            logger.error(f"Warm-up failed, retrying in {WARM_UP_RETRY_SECONDS}s: {e}")
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+
+@app.before_serving
+async def startup():
+    if LAZY_STARTUP:
+        app.add_background_task(warm_up_in_background)
+    else:
+        await warm_up()
+
+@app.after_serving
+async def shutdown():
+    await db_service.close_async_connection()
+
+@app.route('/icloud_auth')
+async def server_auth():
+    key = request.args.get('key')
+    if key != SERVER_KEY:
+        abort(401, description="Unauthorized")
+    account = request.args.get('account') or DEFAULT_ICLOUD_ACCOUNT
+    if account not in ICLOUD_ACCOUNT_PASSWORDS:
+        abort(400, description="Unknown iCloud account")
+    return await render_template_string(AUTH_PAGE_TEMPLATE, key=key, account=account)
+
+@app.route('/submit_code', methods=['POST'])
+async def submit_code():
+    form = await request.form
+    key = form.get('key')
+    if key != SERVER_KEY:
+        abort(401, description="Unauthorized")
+    account = form.get('account') or DEFAULT_ICLOUD_ACCOUNT
+    if account not in ICLOUD_ACCOUNT_PASSWORDS:
+        abort(400, description="Unknown iCloud account")
+    # Код уходит через MongoDB процессу синхронизации, который ждёт входа
+    await asyncio.to_thread(auth_broker.submit_code, form.get('code'), account)
+    return "Code submitted successfully"
+
+@app.route('/ready', methods=['GET'])
+async def readiness():
+    if warm_up_done.is_set():
+        return jsonify({'status': 'ready'})
+    return jsonify({'status': 'warming_up'}), 503
+
+@app.route('/privacy', methods=['GET'])
+async def privacy_policy():
+    return await send_file('privacy_policy.html')
+
+def require_api_key(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        api_key = bearer_api_key(request.headers.get('Authorization'))
+        try:
+            tenant = await tenant_registry.resolve_async(api_key)
+        except Exception as e:
+            logger.error(f"Failed to resolve API key: {e}")
+            abort(503, description="Service unavailable")
+        if tenant is None:
+            abort(401, description="Unauthorized: Invalid API key")
+        g.tenant = tenant
+        return await f(*args, **kwargs)
+    return decorated_function
+
+async def iter_ndjson_lines(lines):
+    """Каждая строка считает токены tiktoken, поэтому формируется в потоке, не блокируя цикл событий."""
+    while True:
+        line = await asyncio.to_thread(next, lines, None)
+        if line is None:
+            break
+        yield line
+
+@app.route('/search', methods=['POST'])
+@require_api_key
+async def search():
+    limits = tenant_registry.limits_for(g.tenant)
+    refusal = limits.try_acquire()
+    if refusal:
+        return jsonify({'error': refusal}), 429
+    try:
+        return await run_search(await request.get_json(), g.tenant['owner_id'])
+    finally:
+        limits.release()
+
+async def run_search(data, owner_id):
+    # Подсчёт и обрезка токенов запроса занимают процессор пропорционально длине текста, поэтому идут в потоке
+    params, error = await asyncio.to_thread(parse_search_request, data)
+    if error:
+        return jsonify({'error': error}), 400
+    query_text = params['query_text']
+    token_budget = params['token_budget']
+
+    results = await search_notes_async(
+        db_service,
+        query_text,
+        owner_id,
+        folder_id=params['folder_id'],
+        folder_name=params['folder_name'],
+        edited_after=params['edited_after'],
+        edited_before=params['edited_before'],
+        recency_half_life_days=params['recency_half_life_days']
+    )
+
+    if not results:
+        return jsonify({'error': 'No results found or an error occurred'}), 404
+
+    header = search_response_header()
+
+    if wants_stream(data, request.headers.get('Accept')):
+        # Результаты уже прочитаны, поэтому слот владельца освобождается сразу, а строки NDJSON
+        # форматируются по мере отправки
+        lines = iter_ndjson_search_response(header, results, query_text, token_budget)
+        return Response(iter_ndjson_lines(lines), mimetype='application/x-ndjson')
+
+    response_text = await asyncio.to_thread(build_search_response, header, results, query_text, token_budget)
+
+    return jsonify({'response': response_text})
+
+@app.route('/accept_shared_folder', methods=['POST'])
+@require_api_key
+async def accept_shared_folder_route():
+    data = await request.get_json()
+    if not data or 'url' not in data:
+        logger.error("Missing url parameter")
+        return jsonify({'error': 'Missing url parameter'}), 400
+
+    url = data['url']
+    guid = extract_invite_guid(url)
+    if not guid:
+        logger.error(f"Invalid URL format: {url}")
+        return jsonify({'error': 'Invalid URL format'}), 400
+
+    try:
+        # Приглашение примет процесс синхронизации, клиент проверяет статус задачи по job_id
+        job_id = await asyncio.to_thread(sync_workers.enqueue_accept_invite, guid, g.tenant['owner_id'])
+        return jsonify({
+            'message': f'Shared folder invitation queued for GUID: {guid}',
+            'job_id': job_id,
+            'status_url': f'/sync_jobs/{job_id}'
+        }), 202
+    except Exception as e:
+        logger.exception(f"Error queueing shared folder invitation: {str(e)}")
+        return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
+
+@app.route('/sync_jobs/<job_id>', methods=['GET'])
+@require_api_key
+async def sync_job_status(job_id):
+    job = await asyncio.to_thread(db_service.get_sync_job, job_id, g.tenant['owner_id'])
+    if not job:
+        return jsonify({'error': 'Sync job not found'}), 404
+    return jsonify(job)
+
+
+if __name__ == "__main__":
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [ASYNC_SERVER_BIND]
+    logger.info(f"Starting async server on {ASYNC_SERVER_BIND}...")
+    asyncio.run(serve(app, config))
@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+import threading
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждём ввода кода подтверждения 2FA (в секундах)
+AUTH_CODE_TIMEOUT = float(os.getenv('AUTH_CODE_TIMEOUT', '300'))
+# Как часто проверяем код в MongoDB, если change streams недоступны (в секундах)
+AUTH_CODE_CHECK_INTERVAL = 1.0
+
+
+class AuthBroker:
+    """
+    Передаёт код 2FA из /submit_code ожидающему входу в аккаунт iCloud.
+    Если подключена база, код хранится в документе settings (MongoDB), и его получает процесс,
+    который ждёт входа, даже если код введён в другом процессе: ожидающего будит change stream.
+    Без базы код передаётся внутри процесса через threading.Event. Коды разных аккаунтов не пересекаются.
+    """
+
+    def __init__(self):
+        self.db_service = None
+        self.lock = threading.Lock()
+        self.code_events = {}
+        self.codes = {}
+
+    def attach(self, db_service):
+        self.db_service = db_service
+
+    def _code_event(self, account):
+        with self.lock:
+            return self.code_events.setdefault(account, threading.Event())
+
+    def submit_code(self, code, account):
+        if self.db_service:
+            self.db_service.submit_auth_code(code, account)
+        with self.lock:
+            self.codes[account] = code
+        self._code_event(account).set()
+        logger.info(f"Verification code submitted for {account}")
+
+    def wait_for_code(self, account, timeout=AUTH_CODE_TIMEOUT):
+        """
+        Ждёт код для account, введённый после начала ожидания.
+
+        :return: Код или None, если он не был введён за timeout секунд
+        """
+        deadline = time.monotonic() + timeout
+        code_event = self._code_event(account)
+        with self.lock:
+            self.codes.pop(account, None)
+        code_event.clear()
+        if self.db_service:
+            # Старый неиспользованный код не должен подойти к новому входу
+            self.db_service.request_auth_code(account)
+
+        stream = self._watch(account)
+        try:
+            while True:
+                code = self._take_code(account)
+                if code:
+                    return code
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if stream is not None:
+                    try:
+                        # Возвращается при изменении документа с кодом или через max_await_time_ms
+                        stream.try_next()
+                    except PyMongoError as e:
+                        # Например, change stream закрыт после смены primary: дальше проверяем код по таймеру
+                        logger.info(f"Change stream failed, checking for the code every {AUTH_CODE_CHECK_INTERVAL}s: {e}")
+                        self._close_stream(stream)
+                        stream = None
+                elif self.db_service:
+                    code_event.wait(min(remaining, AUTH_CODE_CHECK_INTERVAL))
+                else:
+                    code_event.wait(remaining)
+        finally:
+            if stream is not None:
+                self._close_stream(stream)
+
+    def _close_stream(self, stream):
+        try:
+            stream.close()
+        except PyMongoError as e:
+            logger.debug(f"Failed to close change stream: {e}")
+
+    def _take_code(self, account):
+        self._code_event(account).clear()
+        with self.lock:
+            code = self.codes.pop(account, None)
+        if self.db_service:
+            # Код в базе — общий для всех процессов, локальная копия только будит ожидание
+            return self.db_service.take_auth_code(account)
+        return code
+
+    def _watch(self, account):
+        if not self.db_service:
+            return None
+        try:
+            return self.db_service.watch_auth_code(account)
+        except PyMongoError as e:
+            logger.info(f"Change streams are unavailable, checking for the code every {AUTH_CODE_CHECK_INTERVAL}s: {e}")
+            return None
+
+
+auth_broker = AuthBroker()
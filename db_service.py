@@ -1,5 +1,13 @@
 import os
-from pymongo import MongoClient
+import json
+import pymongo
+from pymongo import MongoClient, AsyncMongoClient, ReturnDocument, UpdateOne
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+from pymongo.operations import SearchIndexModel
+from pymongo.errors import DuplicateKeyError
+import bson
+from bson import ObjectId
+from bson.errors import InvalidId
 from pymongo.server_api import ServerApi
 from dotenv import load_dotenv
 import logging
@@ -7,6 +15,7 @@ import certifi
 from http.cookiejar import Cookie
 from icloudpy import ICloudPyService
 import time
+import re
 
 # Настройка логирования
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,32 +27,266 @@ load_dotenv()
 ICLOUD_USERNAME = os.getenv('ICLOUD_USERNAME')
 ICLOUD_PASSWORD = os.getenv('ICLOUD_PASSWORD')
 
+# Коллекция и векторный индекс, с которыми работают поиск и синхронизация, пока в settings не записано другое.
+# Поля embedding_model, dimensions и max_tokens без значения означают параметры по умолчанию из embeddings_service
+DEFAULT_ACTIVE_INDEX = {
+    'collection': 'notes',
+    'index_name': 'content_vector_index',
+    'embedding_model': None,
+    'dimensions': None,
+    'max_tokens': None
+}
+# Во сколько раз больше кандидатов берём из векторного поиска для переранжирования по свежести
+RECENCY_RERANK_FACTOR = int(os.getenv('RECENCY_RERANK_FACTOR', '3'))
+# Минимальный множитель score для самых старых заметок при переранжировании по свежести
+RECENCY_MIN_WEIGHT = float(os.getenv('RECENCY_MIN_WEIGHT', '0.5'))
+# Как часто перечитывать активный индекс, чтобы все процессы увидели переключение после переиндексации
+ACTIVE_INDEX_REFRESH_SECONDS = float(os.getenv('ACTIVE_INDEX_REFRESH_SECONDS', '30'))
+# Заметки больше этого размера (в байтах BSON) не сохраняются в чекпоинты: документ MongoDB ограничен 16 МБ.
+# После перезапуска такие заметки просто загружаются из iCloud заново
+SYNC_CHECKPOINT_NOTE_MAX_BYTES = int(os.getenv('SYNC_CHECKPOINT_NOTE_MAX_BYTES', str(8 * 1024 * 1024)))
+# Попытки поставить задачу в очередь при гонке с параллельным запросом за тот же dedupe_key
+SYNC_JOB_ENQUEUE_ATTEMPTS = 3
+
+# Синхронизация (массовые записи, полные обходы коллекций) и поиск работают через разные клиенты MongoDB,
+# чтобы большая синхронизация не занимала соединения, которых ждёт поиск
+MONGODB_SYNC_POOL_SIZE = int(os.getenv('MONGODB_SYNC_POOL_SIZE', '10'))
+MONGODB_SEARCH_POOL_SIZE = int(os.getenv('MONGODB_SEARCH_POOL_SIZE', '50'))
+MONGODB_SEARCH_MIN_POOL_SIZE = int(os.getenv('MONGODB_SEARCH_MIN_POOL_SIZE', '2'))
+# Куда направлять чтения поиска: secondaryPreferred или nearest снимают $vectorSearch с primary,
+# на который пишет синхронизация. Теги (JSON, например [{"nodeType": "ANALYTICS"}]) выбирают отдельные узлы для поиска
+MONGODB_SEARCH_READ_PREFERENCE = os.getenv('MONGODB_SEARCH_READ_PREFERENCE', 'primary')
+MONGODB_SEARCH_READ_PREFERENCE_TAGS = json.loads(os.getenv('MONGODB_SEARCH_READ_PREFERENCE_TAGS', '[]'))
+# Максимальное отставание вторичного узла для поиска (в секундах, не меньше 90; -1 — без ограничения)
+MONGODB_SEARCH_MAX_STALENESS_SECONDS = int(os.getenv('MONGODB_SEARCH_MAX_STALENESS_SECONDS', '-1'))
+# Таймауты операций (в мс, 0 — без ограничения): поиск лучше быстро вернуть ошибку, чем ждать за синхронизацией;
+# записи синхронизации и полные обходы ограничены, чтобы зависшая операция не держала воркер
+MONGODB_SEARCH_TIMEOUT_MS = int(os.getenv('MONGODB_SEARCH_TIMEOUT_MS', '5000'))
+MONGODB_SYNC_WRITE_TIMEOUT_MS = int(os.getenv('MONGODB_SYNC_WRITE_TIMEOUT_MS', '30000'))
+MONGODB_SYNC_SCAN_TIMEOUT_MS = int(os.getenv('MONGODB_SYNC_SCAN_TIMEOUT_MS', '300000'))
+
+
+def search_read_preference():
+    """Предпочтение чтения для поиска из MONGODB_SEARCH_READ_PREFERENCE и тегов узлов."""
+    mode = read_pref_mode_from_name(MONGODB_SEARCH_READ_PREFERENCE)
+    if mode == 0:
+        # primary не допускает тегов и ограничения отставания
+        return make_read_preference(mode, None)
+    return make_read_preference(mode, MONGODB_SEARCH_READ_PREFERENCE_TAGS or None, MONGODB_SEARCH_MAX_STALENESS_SECONDS)
+
+
+def operation_timeout(timeout_ms):
+    """Таймаут всех операций MongoDB внутри блока with; 0 снимает ограничение."""
+    return pymongo.timeout(timeout_ms / 1000 if timeout_ms > 0 else None)
+
+
+def vector_index_definition(dimensions):
+    """Определение Atlas Vector Search индекса по эмбеддингам чанков."""
+    return {
+        'fields': [
+            {'type': 'vector', 'path': 'embeddings', 'numDimensions': dimensions, 'similarity': 'cosine'},
+            {'type': 'filter', 'path': 'owner_id'},
+            {'type': 'filter', 'path': 'folder_id'},
+            {'type': 'filter', 'path': 'folder_name'},
+            {'type': 'filter', 'path': 'last_edited_date'}
+        ]
+    }
+
+
 class DatabaseService:
-    def __init__(self):
+    def __init__(self, lazy=False):
+        """
+        :param lazy: Не подключаться к MongoDB при создании: пинг, индексы и соединения пула
+                     откладываются до warm_up() или первого запроса
+        """
         self.client = None
         self.db = None
-        self.notes_collection = None
-        self.initialize_db()
+        # Клиент поиска: свой пул соединений, предпочтение чтения и таймаут операций
+        self.search_client = None
+        self.search_db = None
+        # Асинхронный клиент поиска для async_server.py создаётся при первом обращении внутри цикла событий
+        self.async_client = None
+        self.async_db = None
+        self.ready = False
+        self._active_index = None
+        self._active_index_loaded_at = 0
+        self.initialize_db(lazy)
 
-    def initialize_db(self):
+    @property
+    def notes_collection(self):
+        """Коллекция чанков активного индекса."""
+        return self.db[self.get_active_index()['collection']]
+
+    def initialize_db(self, lazy=False):
         try:
             uri = os.getenv('MONGODB_URI')
             if not uri:
                 raise ValueError("MONGODB_URI not found in environment variables")
+            self.uri = uri
 
             # self.client = MongoClient(uri, server_api=ServerApi('1'))
-            self.client = MongoClient(uri, server_api=ServerApi('1'), tlsCAFile=certifi.where())
+            self.client = MongoClient(uri, server_api=ServerApi('1'), tlsCAFile=certifi.where(), connect=not lazy,
+                                      maxPoolSize=MONGODB_SYNC_POOL_SIZE, appname='sharing-app-sync')
             self.db = self.client['apple-notes']
-            self.notes_collection = self.db['notes']
+            self.search_client = MongoClient(uri, connect=not lazy, **self._search_client_options())
+            self.search_db = self.search_client.get_database('apple-notes', read_preference=search_read_preference())
+            self.settings_collection = self.db['settings']
             self.sessions_collection = self.db['sessions']
-            
+            self.skipped_notes_collection = self.db['skipped_notes']
+            self.sync_jobs_collection = self.db['sync_jobs']
+            self.sync_checkpoints_collection = self.db['sync_checkpoints']
+            # Чанки с эмбеддингами из чекпоинтов, по документу на чанк: вместе они могут превысить 16 МБ
+            self.sync_checkpoint_chunks_collection = self.db['sync_checkpoint_chunks']
+            self.sync_zones_collection = self.db['sync_zones']
+            self.leases_collection = self.db['leases']
+            self.api_keys_collection = self.db['api_keys']
+        except Exception as e:
+            logger.error(f"An error occurred while connecting to MongoDB: {e}")
+            raise
+
+        if lazy:
+            logger.info("MongoDB connection is deferred until warm-up")
+            return
+        self.warm_up()
+
+    def _search_client_options(self):
+        return {
+            'server_api': ServerApi('1'),
+            'tlsCAFile': certifi.where(),
+            'maxPoolSize': MONGODB_SEARCH_POOL_SIZE,
+            'minPoolSize': MONGODB_SEARCH_MIN_POOL_SIZE,
+            'timeoutMS': MONGODB_SEARCH_TIMEOUT_MS or None,
+            'appname': 'sharing-app-search'
+        }
+
+    def warm_up(self):
+        """Проверяет подключение, создаёт индексы и загружает активный индекс, открывая соединения пулов."""
+        try:
             # Проверка подключения
             self.client.admin.command('ping')
+            self.search_client.admin.command('ping')
             logger.info("Successfully connected to MongoDB")
+
+            # Не больше одной ожидающей задачи синхронизации на один dedupe_key
+            self.sync_jobs_collection.create_index(
+                'dedupe_key', unique=True, partialFilterExpression={'status': 'pending'}
+            )
+            self.sync_checkpoints_collection.create_index('record_id', unique=True)
+            self.sync_checkpoint_chunks_collection.create_index([('record_id', 1), ('index', 1)])
+            self.sync_zones_collection.create_index('zone_id')
+            self.sync_zones_collection.create_index('next_sync_at')
+            self.get_active_index(refresh=True)
+            self.ensure_notes_indexes(self.notes_collection)
+            self.ready = True
         except Exception as e:
             logger.error(f"An error occurred while connecting to MongoDB: {e}")
             raise
 
+    def ensure_notes_indexes(self, collection):
+        collection.create_index('note_id')
+        collection.create_index('zone_id')
+        # Полнотекстовый индекс для лексического поиска; без стемминга, так как заметки на разных языках
+        collection.create_index(
+            [('title', 'text'), ('text', 'text')],
+            name='title_text_text_index',
+            default_language='none',
+            weights={'title': 3, 'text': 1}
+        )
+
+    # Активный индекс и переключение между коллекциями
+    def get_active_index(self, refresh=False):
+        """Возвращает описание активной коллекции чанков, её векторного индекса и параметров эмбеддингов."""
+        now = time.monotonic()
+        if refresh or self._active_index is None or now - self._active_index_loaded_at > ACTIVE_INDEX_REFRESH_SECONDS:
+            try:
+                # Читается на каждом поиске, поэтому идёт через пул поиска, но всегда с primary:
+                # после переключения индекса вторичный узел может ещё вернуть прежнюю коллекцию
+                settings = self.search_client['apple-notes']['settings'].find_one({'_id': 'active_index'})
+                self._set_active_index(settings, now)
+            except Exception as e:
+                # Если база недоступна, продолжаем работать с последним известным индексом
+                logger.error(f"Failed to load active index settings: {e}")
+                if self._active_index is None:
+                    return dict(DEFAULT_ACTIVE_INDEX)
+        return self._active_index
+
+    def _set_active_index(self, settings, loaded_at):
+        active_index = dict(DEFAULT_ACTIVE_INDEX)
+        active_index.update((settings or {}).get('current', {}))
+        self._active_index = active_index
+        self._active_index_loaded_at = loaded_at
+
+    def switch_active_index(self, new_index):
+        """Атомарно делает new_index активным, сохраняя прежний для отката."""
+        self.settings_collection.update_one(
+            {'_id': 'active_index'},
+            [{'$set': {
+                'previous': {'$ifNull': ['$current', {'$literal': DEFAULT_ACTIVE_INDEX}]},
+                'current': {'$literal': new_index},
+                'switched_at': int(time.time() * 1000)
+            }}],
+            upsert=True
+        )
+        logger.info(f"Switched active index to collection {new_index['collection']}")
+        return self.get_active_index(refresh=True)
+
+    def rollback_active_index(self):
+        """Возвращает предыдущий активный индекс. Старая коллекция при переключении не удаляется."""
+        settings = self.settings_collection.find_one({'_id': 'active_index'})
+        if not settings or 'previous' not in settings:
+            raise ValueError("No previous index to roll back to")
+        self.settings_collection.update_one(
+            {'_id': 'active_index'},
+            [{'$set': {'current': '$previous', 'previous': '$current', 'switched_at': int(time.time() * 1000)}}]
+        )
+        active_index = self.get_active_index(refresh=True)
+        logger.info(f"Rolled back active index to collection {active_index['collection']}")
+        return active_index
+
+    def create_shadow_collection(self, index):
+        """Создаёт коллекцию и векторный индекс для переиндексации, не затрагивая активный индекс."""
+        if index['collection'] not in self.db.list_collection_names():
+            self.db.create_collection(index['collection'])
+        collection = self.db[index['collection']]
+        self.ensure_notes_indexes(collection)
+        collection.create_search_index(SearchIndexModel(
+            definition=vector_index_definition(index['dimensions']),
+            name=index['index_name'],
+            type='vectorSearch'
+        ))
+        logger.info(f"Created shadow collection {index['collection']} with vector index {index['index_name']}")
+        return collection
+
+    def wait_for_search_index(self, collection, index_name, timeout=600, poll_interval=5):
+        """Ждёт, пока Atlas построит векторный индекс и он станет доступен для запросов."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            indexes = list(collection.list_search_indexes(index_name))
+            if indexes and indexes[0].get('queryable'):
+                return True
+            time.sleep(poll_interval)
+        return False
+
+    def update_vector_index_definition(self):
+        """
+        Обновляет определение векторного индекса активной коллекции (например, чтобы добавить поля фильтров).
+        Atlas перестраивает индекс в фоне, запросы продолжают работать со старой версией.
+        """
+        active_index = self.get_active_index(refresh=True)
+        dimensions = active_index['dimensions'] or int(os.getenv('EMBEDDING_DIMENSIONS', '3072'))
+        self.db[active_index['collection']].update_search_index(active_index['index_name'], vector_index_definition(dimensions))
+        logger.info(f"Updated definition of vector index {active_index['index_name']}")
+
+    def update_reindex_status(self, status):
+        self.settings_collection.update_one(
+            {'_id': 'reindex'},
+            {'$set': dict(status, updated_at=int(time.time() * 1000))},
+            upsert=True
+        )
+
+    def get_reindex_status(self):
+        return self.settings_collection.find_one({'_id': 'reindex'}, {'_id': 0})
+
     def insert_or_update(self, note_data):
         try:
             # Проверяем наличие обязательных полей
@@ -58,7 +301,8 @@ class DatabaseService:
             update = {"$set": note_data}
 
             # Вставка или обновление документа
-            result = self.notes_collection.update_one(query, update, upsert=True)
+            with operation_timeout(MONGODB_SYNC_WRITE_TIMEOUT_MS):
+                result = self.notes_collection.update_one(query, update, upsert=True)
 
             if result.upserted_id:
                 logger.info(f"Inserted new note with ID: {result.upserted_id}")
@@ -73,58 +317,658 @@ class DatabaseService:
 
     def get_last_edited_dates(self):
         result = {}
-        for note in self.notes_collection.find({}, {'record_id': 1, 'last_edited_date': 1}):
-            result[note['record_id']] = note['last_edited_date']
+        with operation_timeout(MONGODB_SYNC_SCAN_TIMEOUT_MS):
+            # Чанки одной заметки учитываем по note_id, чтобы сравнение шло с recordName из iCloud
+            for note in self.notes_collection.find({}, {'record_id': 1, 'note_id': 1, 'last_edited_date': 1}):
+                result[note.get('note_id', note['record_id'])] = note['last_edited_date']
+            # Пропущенные заметки не запрашиваем повторно, пока они не изменятся. Заметка могла быть проиндексирована
+            # раньше и пропущена позже, поэтому берём более позднюю из дат
+            for note in self.skipped_notes_collection.find({}, {'record_id': 1, 'last_edited_date': 1}):
+                result[note['record_id']] = max(result.get(note['record_id'], 0), note['last_edited_date'])
+        return result
+
+    def get_payload_hashes(self):
+        """Возвращает хеши TextDataEncrypted, по которым были построены чанки каждой заметки."""
+        result = {}
+        with operation_timeout(MONGODB_SYNC_SCAN_TIMEOUT_MS):
+            for note in self.notes_collection.find({'payload_hash': {'$exists': True}}, {'note_id': 1, 'payload_hash': 1}):
+                result[note['note_id']] = note['payload_hash']
         return result
+
+    def update_note_metadata(self, note_data):
+        """
+        Обновляет метаданные всех чанков заметки, не трогая эмбеддинги.
+        Заголовок чанка содержит название папки, поэтому при переносе заметки он переписывается.
+        """
+        try:
+            metadata = {field: note_data[field] for field in ('last_edited_date', 'folder_id', 'folder_name', 'owner_id')}
+            with operation_timeout(MONGODB_SYNC_WRITE_TIMEOUT_MS):
+                chunks = self.notes_collection.find({'note_id': note_data['record_id']}, {'record_id': 1, 'text': 1, 'folder_name': 1})
+
+                for chunk in chunks:
+                    update = dict(metadata)
+                    old_header = f"Folder: {chunk.get('folder_name')}\n"
+                    if chunk.get('folder_name') != metadata['folder_name'] and chunk['text'].startswith(old_header):
+                        update['text'] = f"Folder: {metadata['folder_name']}\n" + chunk['text'][len(old_header):]
+                    self.notes_collection.update_one({'record_id': chunk['record_id']}, {'$set': update})
+
+            logger.info(f"Updated metadata for note with ID: {note_data['record_id']}")
+        except Exception as e:
+            logger.error(f"An error occurred while updating note metadata: {e}")
+            raise
+
+    def record_skipped_notes(self, skipped_notes):
+        """Сохраняет заметки, пропущенные при синхронизации (слишком большие, таймаут, ошибка декодирования)."""
+        for skipped_note in skipped_notes:
+            try:
+                update = {
+                    "$set": dict(skipped_note, skipped_at=int(time.time() * 1000)),
+                    "$inc": {"skip_count": 1}
+                }
+                self.skipped_notes_collection.update_one({"record_id": skipped_note["record_id"]}, update, upsert=True)
+                logger.info(f"Recorded skipped note {skipped_note['record_id']}: {skipped_note['reason']}")
+            except Exception as e:
+                logger.error(f"An error occurred while recording skipped note: {e}")
     
+    # Методы удаления мёртвых заметок из индекса
+    def _purge_sync_state(self, query):
+        self.sync_checkpoints_collection.delete_many(query)
+        self.sync_checkpoint_chunks_collection.delete_many(query)
+        self.skipped_notes_collection.delete_many(query)
+
+    def delete_notes(self, note_ids):
+        """Удаляет все чанки заметок note_ids. Возвращает количество удалённых чанков."""
+        if not note_ids:
+            return 0
+        note_ids = list(note_ids)
+        # Старые чанки без note_id находим по record_id вида "<note_id>-<i>"
+        chunk_pattern = '^(' + '|'.join(re.escape(note_id) for note_id in note_ids) + r')-\d+$'
+        # Регулярное выражение по record_id обходит всю коллекцию
+        with operation_timeout(MONGODB_SYNC_SCAN_TIMEOUT_MS):
+            result = self.notes_collection.delete_many({'$or': [
+                {'note_id': {'$in': note_ids}},
+                {'record_id': {'$in': note_ids}},
+                {'record_id': {'$regex': chunk_pattern}}
+            ]})
+            self._purge_sync_state({'record_id': {'$in': note_ids}})
+        logger.info(f"Deleted {result.deleted_count} chunks of {len(note_ids)} deleted notes")
+        return result.deleted_count
+
+    def delete_zone_notes_except(self, zone_id, live_note_ids):
+        """Удаляет чанки зоны, заметок которых в ней больше нет."""
+        live_note_ids = list(live_note_ids)
+        with operation_timeout(MONGODB_SYNC_SCAN_TIMEOUT_MS):
+            result = self.notes_collection.delete_many({'zone_id': zone_id, 'note_id': {'$nin': live_note_ids}})
+            self._purge_sync_state({'zone_id': zone_id, 'record_id': {'$nin': live_note_ids}})
+        if result.deleted_count:
+            logger.info(f"Deleted {result.deleted_count} chunks of notes missing from zone {zone_id}")
+        return result.deleted_count
+
+    def delete_notes_outside_zones(self, zone_ids, account_zone_ids=None):
+        """
+        Удаляет чанки зон, к которым у аккаунта больше нет доступа.
+
+        :param account_zone_ids: Если задано, удаляются только эти зоны аккаунта: зоны других аккаунтов пула не трогаем
+        """
+        zone_ids = list(zone_ids)
+        if account_zone_ids is not None:
+            lost_zone_ids = list(set(account_zone_ids) - set(zone_ids))
+            if not lost_zone_ids:
+                return 0
+            query = {'zone_id': {'$in': lost_zone_ids}}
+        else:
+            # Чанки без zone_id (сохранённые до его появления) не трогаем
+            query = {'zone_id': {'$nin': zone_ids + [None]}}
+        with operation_timeout(MONGODB_SYNC_SCAN_TIMEOUT_MS):
+            result = self.notes_collection.delete_many(query)
+            self._purge_sync_state(query)
+            self.sync_zones_collection.delete_many(query)
+        if result.deleted_count:
+            logger.info(f"Deleted {result.deleted_count} chunks from zones that are no longer shared")
+        return result.deleted_count
+
+    def delete_stale_note_chunks(self, note_id, record_ids):
+        """Удаляет чанки, оставшиеся от прошлой версии заметки, если она стала короче."""
+        with operation_timeout(MONGODB_SYNC_WRITE_TIMEOUT_MS):
+            result = self.notes_collection.delete_many({'note_id': note_id, 'record_id': {'$nin': list(record_ids)}})
+        return result.deleted_count
+
+    # Методы чекпоинтов синхронизации
+    def save_note_checkpoints(self, notes, stage):
+        """
+        Сохраняет заметки, дошедшие до этапа stage. Новая версия заметки сбрасывает посчитанные ранее чанки.
+        Заметки больше SYNC_CHECKPOINT_NOTE_MAX_BYTES не сохраняются, а их прежние чекпоинты удаляются.
+        """
+        if not notes:
+            return
+        oversized = [note['record_id'] for note in notes if len(bson.encode(note)) > SYNC_CHECKPOINT_NOTE_MAX_BYTES]
+        if oversized:
+            logger.warning(f"Notes {oversized} are too large for sync checkpoints")
+            self.sync_checkpoints_collection.delete_many({'record_id': {'$in': oversized}})
+            notes = [note for note in notes if note['record_id'] not in oversized]
+        now = int(time.time() * 1000)
+        operations = [
+            UpdateOne(
+                {'record_id': note['record_id']},
+                {
+                    '$set': {'note': note, 'zone_id': note['zone_id'], 'stage': stage, 'updated_at': now},
+                    '$unset': {'chunks': '', 'chunk_count': ''},
+                    '$setOnInsert': {'failures': 0}
+                },
+                upsert=True
+            )
+            for note in notes
+        ]
+        if operations:
+            self.sync_checkpoints_collection.bulk_write(operations, ordered=False)
+        self.sync_checkpoint_chunks_collection.delete_many({'record_id': {'$in': [note['record_id'] for note in notes] + oversized}})
+
+    def save_note_checkpoint_chunks(self, record_id, zone_id, chunks):
+        """
+        Сохраняет чанки с эмбеддингами, чтобы не пересчитывать их после перезапуска.
+        Этап embedded записывается после всех чанков, поэтому прерванное сохранение просто посчитает их заново.
+        """
+        self.sync_checkpoint_chunks_collection.delete_many({'record_id': record_id})
+        self.sync_checkpoint_chunks_collection.insert_many([
+            {'record_id': record_id, 'zone_id': zone_id, 'index': index, 'text': chunk_text, 'embeddings': embeddings}
+            for index, (chunk_text, embeddings) in enumerate(chunks)
+        ])
+        self.sync_checkpoints_collection.update_one(
+            {'record_id': record_id},
+            {'$set': {'stage': 'embedded', 'chunk_count': len(chunks), 'updated_at': int(time.time() * 1000)}}
+        )
+
+    def complete_note_checkpoint(self, record_id):
+        """Заметка записана в notes, чекпоинт больше не нужен."""
+        self.sync_checkpoints_collection.delete_one({'record_id': record_id})
+        self.sync_checkpoint_chunks_collection.delete_many({'record_id': record_id})
+
+    def record_note_checkpoint_failure(self, record_id, error):
+        """Увеличивает счётчик ошибок заметки и возвращает его новое значение."""
+        checkpoint = self.sync_checkpoints_collection.find_one_and_update(
+            {'record_id': record_id},
+            {'$inc': {'failures': 1}, '$set': {'last_error': error, 'updated_at': int(time.time() * 1000)}},
+            return_document=ReturnDocument.AFTER
+        )
+        return checkpoint['failures'] if checkpoint else 1
+
+    def get_pending_note_checkpoints(self, zone_ids=None):
+        """Незавершённые чекпоинты; у заметок на этапе embedded в chunks подставляются сохранённые чанки."""
+        query = {'zone_id': {'$in': list(zone_ids)}} if zone_ids is not None else {}
+        checkpoints = list(self.sync_checkpoints_collection.find(query, {'_id': 0}))
+        for checkpoint in checkpoints:
+            if checkpoint['stage'] != 'embedded':
+                continue
+            chunks = self.sync_checkpoint_chunks_collection.find(
+                {'record_id': checkpoint['record_id']}, {'_id': 0, 'text': 1, 'embeddings': 1}
+            ).sort('index', 1)
+            chunks = [(chunk['text'], chunk['embeddings']) for chunk in chunks]
+            if len(chunks) == checkpoint.get('chunk_count'):
+                checkpoint['chunks'] = chunks
+            else:
+                # Чанки сохранены не полностью: эмбеддинги будут посчитаны заново
+                checkpoint['stage'] = 'decoded'
+        return checkpoints
+
+    def update_zone_sync_progress(self, zone_id, status, progress, account=None):
+        """:param account: Аккаунт, который синхронизирует зону; зона закрепляется за ним уже на первой синхронизации"""
+        now = int(time.time() * 1000)
+        update = {'$set': dict(progress, status=status, updated_at=now)}
+        if account is not None:
+            update['$set']['account'] = account
+        if status == 'in_progress':
+            update['$set']['started_at'] = now
+        else:
+            update['$set']['finished_at'] = now
+        self.sync_zones_collection.update_one({'zone_id': zone_id}, update, upsert=True)
+
+    # Расписание опроса зон
+    def get_zone_schedules(self, zone_ids):
+        zones = self.sync_zones_collection.find(
+            {'zone_id': {'$in': list(zone_ids)}},
+            {'_id': 0, 'zone_id': 1, 'poll_interval': 1, 'change_rate': 1}
+        )
+        return {zone['zone_id']: zone for zone in zones}
+
+    def save_zone_schedules(self, schedules):
+        if not schedules:
+            return
+        self.sync_zones_collection.bulk_write([
+            UpdateOne({'zone_id': schedule['zone_id']}, {'$set': schedule}, upsert=True)
+            for schedule in schedules
+        ])
+
+    def claim_due_zones(self, limit, claim_seconds):
+        """
+        Выбирает зоны, время опроса которых наступило, и откладывает их следующий опрос на claim_seconds,
+        чтобы они не попали в очередь повторно, пока задача синхронизации ждёт или выполняется.
+
+        :return: Список пар (zone_id, аккаунт iCloud зоны или None для зон, сохранённых до пула аккаунтов)
+        """
+        now = int(time.time() * 1000)
+        due_zones = list(self.sync_zones_collection.find(
+            {'next_sync_at': {'$lte': now}}, {'zone_id': 1, 'account': 1}
+        ).sort('next_sync_at', 1).limit(limit))
+        if due_zones:
+            self.sync_zones_collection.update_many(
+                {'zone_id': {'$in': [zone['zone_id'] for zone in due_zones]}},
+                {'$set': {'next_sync_at': now + claim_seconds * 1000}}
+            )
+        return [(zone['zone_id'], zone.get('account')) for zone in due_zones]
+
+    # Распределение зон между принимающими аккаунтами iCloud
+    def get_account_zone_ids(self, account, include_unassigned=False):
+        """Зоны аккаунта; include_unassigned добавляет зоны без аккаунта, сохранённые до пула аккаунтов."""
+        accounts = [account, None] if include_unassigned else [account]
+        return [zone['zone_id'] for zone in self.sync_zones_collection.find({'account': {'$in': accounts}}, {'zone_id': 1})]
+
+    def count_zones_by_account(self):
+        counts = self.sync_zones_collection.aggregate([{'$group': {'_id': '$account', 'zones': {'$sum': 1}}}])
+        return {entry['_id']: entry['zones'] for entry in counts}
+
+    def count_pending_sync_jobs_by_account(self, job_type):
+        counts = self.sync_jobs_collection.aggregate([
+            {'$match': {'type': job_type, 'status': {'$in': ['pending', 'running']}}},
+            {'$group': {'_id': '$account', 'jobs': {'$sum': 1}}}
+        ])
+        return {entry['_id']: entry['jobs'] for entry in counts}
+
+    # Методы очереди задач синхронизации
+    def enqueue_sync_job(self, job_type, params, dedupe_key, account=None, owner_id=None):
+        """
+        Добавляет задачу в очередь. Если такая же задача уже ожидает выполнения,
+        новая не создаётся, а возвращается существующая.
+
+        :param account: Аккаунт iCloud, воркер которого выполнит задачу
+        :param owner_id: Владелец, поставивший задачу через API; только он видит её статус
+        :return: ID задачи
+        """
+        now = int(time.time() * 1000)
+        query = {'dedupe_key': dedupe_key, 'status': 'pending'}
+        update = {
+            '$setOnInsert': {'type': job_type, 'params': params, 'account': account, 'owner_id': owner_id,
+                             'status': 'pending', 'created_at': now},
+            '$inc': {'requests': 1}
+        }
+        # Параллельный запрос может успеть создать задачу первым (DuplicateKeyError), а воркер — забрать её
+        # до нашего повторного запроса. Тогда повторный upsert увидит уже созданную задачу или создаст новую
+        for attempt in range(SYNC_JOB_ENQUEUE_ATTEMPTS):
+            try:
+                job = self.sync_jobs_collection.find_one_and_update(
+                    query, update, upsert=True, return_document=ReturnDocument.AFTER
+                )
+                break
+            except DuplicateKeyError:
+                if attempt == SYNC_JOB_ENQUEUE_ATTEMPTS - 1:
+                    raise
+                logger.info(f"Sync job {dedupe_key} was created concurrently, retrying")
+
+        logger.info(f"Sync job {job['_id']} ({dedupe_key}) is pending, requested {job['requests']} times")
+        return str(job['_id'])
+
+    def find_pending_sync_job(self, dedupe_key):
+        job = self.sync_jobs_collection.find_one({'dedupe_key': dedupe_key, 'status': 'pending'})
+        return str(job['_id']) if job else None
+
+    def claim_sync_job(self, accounts, worker_id=None, lease_epoch=None):
+        """
+        Забирает самую старую ожидающую задачу аккаунтов accounts и помечает её как выполняемую.
+
+        :param worker_id: Держатель аренды лидера, под которой выполняется задача
+        :param lease_epoch: Эпоха этой аренды; задачу может завершить только воркер с той же эпохой
+        """
+        return self.sync_jobs_collection.find_one_and_update(
+            {'status': 'pending', 'account': {'$in': accounts}},
+            {'$set': {'status': 'running', 'started_at': int(time.time() * 1000),
+                      'worker_id': worker_id, 'lease_epoch': lease_epoch}},
+            sort=[('created_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def finish_sync_job(self, job_id, status, result=None, error=None, lease_epoch=None):
+        """
+        :param lease_epoch: Если задано, задача завершается, только если её ещё выполняет воркер этой эпохи
+                            (её не вернул в очередь новый лидер)
+        """
+        query = {'_id': ObjectId(job_id)}
+        if lease_epoch is not None:
+            query['lease_epoch'] = lease_epoch
+        self.sync_jobs_collection.update_one(
+            query,
+            {'$set': {'status': status, 'result': result, 'error': error, 'finished_at': int(time.time() * 1000)}}
+        )
+
+    def requeue_running_sync_jobs(self, accounts, lease_epoch=None):
+        """
+        Возвращает в очередь задачи аккаунтов accounts, прерванные перезапуском процесса или сменой лидера.
+
+        :param lease_epoch: Текущая эпоха аренды лидера: задачи этой эпохи выполняются сейчас и не трогаются,
+                            задачи прежних эпох остались от держателя, чья аренда истекла
+        """
+        query = {'status': 'running', 'account': {'$in': accounts}}
+        if lease_epoch is not None:
+            query['lease_epoch'] = {'$ne': lease_epoch}
+        running_jobs = self.sync_jobs_collection.find(query, {'dedupe_key': 1})
+        for job in running_jobs:
+            try:
+                self.sync_jobs_collection.update_one({'_id': job['_id']}, {'$set': {'status': 'pending'}})
+                logger.info(f"Requeued interrupted sync job {job['_id']}")
+            except DuplicateKeyError:
+                # Такая же задача уже ждёт в очереди
+                self.finish_sync_job(job['_id'], 'cancelled', error='Superseded by a pending job')
+
+    # Аренды для выбора лидера среди процессов
+    def acquire_lease(self, name, holder, ttl_seconds):
+        """
+        Берёт свободную или просроченную аренду name либо продлевает её, если она уже у holder.
+        Каждый новый срок владения (другой держатель или аренда после истечения) получает следующую эпоху.
+
+        :return: Эпоха аренды, если она принадлежит holder, иначе None
+        """
+        now = int(time.time() * 1000)
+        renewed = {'$and': [{'$eq': ['$holder', holder]}, {'$gte': ['$expires_at', now]}]}
+        try:
+            lease = self.leases_collection.find_one_and_update(
+                {'_id': name, '$or': [{'holder': holder}, {'expires_at': {'$lt': now}}]},
+                [{'$set': {
+                    'epoch': {'$cond': [renewed, '$epoch', {'$add': [{'$ifNull': ['$epoch', 0]}, 1]}]},
+                    'holder': holder,
+                    'expires_at': now + int(ttl_seconds * 1000),
+                    'renewed_at': now
+                }}],
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return lease['epoch']
+        except DuplicateKeyError:
+            # Аренда есть и принадлежит другому процессу
+            return None
+
+    def holds_lease(self, name, holder, epoch):
+        """Аренда name всё ещё у holder в той же эпохе и не истекла."""
+        now = int(time.time() * 1000)
+        return self.leases_collection.count_documents(
+            {'_id': name, 'holder': holder, 'epoch': epoch, 'expires_at': {'$gte': now}}, limit=1
+        ) > 0
+
+    def release_lease(self, name, holder):
+        self.leases_collection.update_one({'_id': name, 'holder': holder}, {'$set': {'expires_at': 0}})
+
+    def get_lease(self, name):
+        return self.leases_collection.find_one({'_id': name})
+
+    # Ключи API владельцев заметок (хранятся хэши ключей)
+    def get_api_key(self, key_hash):
+        return self.search_db['api_keys'].find_one({'_id': key_hash}, {'_id': 0})
+
+    def save_api_key(self, key_hash, owner_id, name=None, **limits):
+        """Сохраняет ключ владельца; limits — max_rps и max_concurrent_searches."""
+        self.api_keys_collection.update_one(
+            {'_id': key_hash},
+            {'$set': {'owner_id': owner_id, 'name': name, 'disabled': False,
+                      'created_at': int(time.time() * 1000), **limits}},
+            upsert=True
+        )
+
+    def disable_api_key(self, key_hash):
+        self.api_keys_collection.update_one({'_id': key_hash}, {'$set': {'disabled': True}})
+
+    # Код подтверждения 2FA, переданный из /submit_code процессу, который входит в аккаунт iCloud
+    def request_auth_code(self, account):
+        self.settings_collection.update_one(
+            {'_id': f'icloud_auth_code:{account}'},
+            {'$set': {'code': None, 'requested_at': int(time.time() * 1000)}},
+            upsert=True
+        )
+
+    def submit_auth_code(self, code, account):
+        self.settings_collection.update_one(
+            {'_id': f'icloud_auth_code:{account}'},
+            {'$set': {'code': code, 'submitted_at': int(time.time() * 1000)}},
+            upsert=True
+        )
+
+    def take_auth_code(self, account):
+        """Забирает введённый код, чтобы он не был использован повторно."""
+        settings = self.settings_collection.find_one_and_update(
+            {'_id': f'icloud_auth_code:{account}', 'code': {'$ne': None}},
+            {'$set': {'code': None}}
+        )
+        return settings['code'] if settings else None
+
+    def watch_auth_code(self, account):
+        """Change stream по документу с кодом; try_next() ждёт изменения не дольше секунды."""
+        return self.settings_collection.watch(
+            [{'$match': {'documentKey._id': f'icloud_auth_code:{account}'}}],
+            max_await_time_ms=1000
+        )
+
+    def get_sync_job(self, job_id, owner_id=None):
+        """:param owner_id: Если задано, задача возвращается, только если её поставил этот владелец"""
+        try:
+            query = {'_id': ObjectId(job_id)}
+        except InvalidId:
+            return None
+        if owner_id is not None:
+            query['owner_id'] = owner_id
+        job = self.sync_jobs_collection.find_one(query)
+        if job:
+            job['job_id'] = str(job.pop('_id'))
+        return job
+
     def close_connection(self):
         if self.client:
             self.client.close()
             logger.info("Closed connection to MongoDB")
+        if self.search_client:
+            self.search_client.close()
+
+    # Асинхронный доступ для async_server.py: поиск и проверка ключей не занимают поток на время запроса
+    def get_async_db(self):
+        if self.async_client is None:
+            self.async_client = AsyncMongoClient(self.uri, **self._search_client_options())
+            self.async_db = self.async_client.get_database('apple-notes', read_preference=search_read_preference())
+        return self.async_db
+
+    async def warm_up_async(self):
+        """Открывает соединения асинхронного клиента и загружает активный индекс."""
+        await self.get_async_db().command('ping')
+        await self.get_active_index_async(refresh=True)
+
+    async def close_async_connection(self):
+        if self.async_client:
+            await self.async_client.close()
+            self.async_client = None
+            self.async_db = None
+            logger.info("Closed async connection to MongoDB")
+
+    async def get_active_index_async(self, refresh=False):
+        now = time.monotonic()
+        if refresh or self._active_index is None or now - self._active_index_loaded_at > ACTIVE_INDEX_REFRESH_SECONDS:
+            try:
+                self.get_async_db()
+                settings = await self.async_client['apple-notes']['settings'].find_one({'_id': 'active_index'})
+                self._set_active_index(settings, now)
+            except Exception as e:
+                logger.error(f"Failed to load active index settings: {e}")
+                if self._active_index is None:
+                    return dict(DEFAULT_ACTIVE_INDEX)
+        return self._active_index
+
+    async def get_api_key_async(self, key_hash):
+        return await self.get_async_db()['api_keys'].find_one({'_id': key_hash}, {'_id': 0})
     
     # Метод для векторного поиска
-    def vector_search_notes(self, query_vector, owner_id, index_name="content_vector_index", limit=5, num_candidates=100):
+    def _search_filter(self, owner_id, folder_id=None, folder_name=None, edited_after=None, edited_before=None):
+        search_filter = {'owner_id': owner_id}
+        if folder_id is not None:
+            search_filter['folder_id'] = folder_id
+        if folder_name is not None:
+            search_filter['folder_name'] = folder_name
+        if edited_after is not None or edited_before is not None:
+            search_filter['last_edited_date'] = {}
+            if edited_after is not None:
+                search_filter['last_edited_date']['$gte'] = edited_after
+            if edited_before is not None:
+                search_filter['last_edited_date']['$lte'] = edited_before
+        return search_filter
+
+    # Метод для лексического поиска
+    def lexical_search_notes(self, query_text, owner_id, limit=5, folder_id=None, folder_name=None,
+                             edited_after=None, edited_before=None):
+        """Полнотекстовый поиск по title и text. score результатов равен textScore."""
         try:
-            pipeline = [
-                {
-                    '$vectorSearch': {
-                        'index': index_name,
-                        'path': 'embeddings', 
-                        'queryVector': query_vector,
-                        'numCandidates': num_candidates,
-                        'limit': limit,
-                        'filter': {
-                            'owner_id': owner_id
-                        }
-                    }
-                },
-                {
-                    '$addFields': {
-                        'score': {'$meta': 'vectorSearchScore'}
-                    }
-                },
-                {
-                    '$project': {
-                        '_id': 0,  # Исключаем поле _id, если оно вам не нужно
-                        'score': 1,  # Явно включаем поле score
-                        # Добавляем все остальные поля
-                        'record_id': 1,
-                        'owner_id': 1, 
-                        'created_date': 1, 
-                        'last_edited_date': 1, 
-                        'folder_name': 1, 
-                        'title': 1,    
-                        'text': 1
-                    }
-                }
-            ]
-            results = list(self.notes_collection.aggregate(pipeline))
-            return results
+            active_index = self.get_active_index()
+            query, projection = self._lexical_search_query(query_text, owner_id, folder_id, folder_name,
+                                                           edited_after, edited_before)
+            cursor = self.search_db[active_index['collection']].find(query, projection)
+            return list(cursor.sort([('score', {'$meta': 'textScore'})]).limit(limit))
+
+        except Exception as e:
+            logger.error(f"Lexical search failed: {e}")
+            return None
+
+    async def lexical_search_notes_async(self, query_text, owner_id, limit=5, folder_id=None, folder_name=None,
+                                         edited_after=None, edited_before=None):
+        """Асинхронный вариант lexical_search_notes."""
+        try:
+            active_index = await self.get_active_index_async()
+            query, projection = self._lexical_search_query(query_text, owner_id, folder_id, folder_name,
+                                                           edited_after, edited_before)
+            cursor = self.get_async_db()[active_index['collection']].find(query, projection)
+            return await cursor.sort([('score', {'$meta': 'textScore'})]).limit(limit).to_list()
+
+        except Exception as e:
+            logger.error(f"Lexical search failed: {e}")
+            return None
+
+    def _lexical_search_query(self, query_text, owner_id, folder_id=None, folder_name=None,
+                              edited_after=None, edited_before=None):
+        query = self._search_filter(owner_id, folder_id, folder_name, edited_after, edited_before)
+        query['$text'] = {'$search': query_text}
+        projection = {
+            '_id': 0,
+            'score': {'$meta': 'textScore'},
+            'record_id': 1,
+            'note_id': 1,
+            'owner_id': 1,
+            'created_date': 1,
+            'last_edited_date': 1,
+            'folder_id': 1,
+            'folder_name': 1,
+            'title': 1,
+            'text': 1
+        }
+        return query, projection
+
+    def vector_search_notes(self, query_vector, owner_id, index_name=None, limit=5, num_candidates=100,
+                            folder_id=None, folder_name=None, edited_after=None, edited_before=None,
+                            recency_half_life_days=None, stream=False):
+        """
+        Векторный поиск по чанкам владельца.
+
+        :param folder_id: Искать только в папке с этим ID
+        :param folder_name: Искать только в папке с этим названием
+        :param edited_after: Искать только чанки, изменённые не раньше этой метки времени (мс)
+        :param edited_before: Искать только чанки, изменённые не позже этой метки времени (мс)
+        :param recency_half_life_days: Если задано, score умножается на вес свежести,
+                                       который уменьшается вдвое за каждые recency_half_life_days дней
+        :param stream: Вернуть курсор агрегации вместо списка, чтобы читать результаты по одному
+        """
+        try:
+            # Коллекцию и индекс берём из одного снимка настроек, чтобы не попасть на момент переключения
+            active_index = self.get_active_index()
+            if index_name is None:
+                index_name = active_index['index_name']
+
+            pipeline = self._vector_search_pipeline(
+                query_vector, owner_id, index_name, limit, num_candidates,
+                folder_id, folder_name, edited_after, edited_before, recency_half_life_days
+            )
+            cursor = self.search_db[active_index['collection']].aggregate(pipeline)
+            if stream:
+                return cursor
+            return list(cursor)
         
         except Exception as e:
             logger.error(f"Vector search failed: {e}")
             return None
 
+    async def vector_search_notes_async(self, query_vector, owner_id, index_name=None, limit=5, num_candidates=100,
+                                        folder_id=None, folder_name=None, edited_after=None, edited_before=None,
+                                        recency_half_life_days=None):
+        """Асинхронный вариант vector_search_notes; возвращает список результатов."""
+        try:
+            active_index = await self.get_active_index_async()
+            if index_name is None:
+                index_name = active_index['index_name']
+            pipeline = self._vector_search_pipeline(
+                query_vector, owner_id, index_name, limit, num_candidates,
+                folder_id, folder_name, edited_after, edited_before, recency_half_life_days
+            )
+            cursor = await self.get_async_db()[active_index['collection']].aggregate(pipeline)
+            return await cursor.to_list()
+
+        except Exception as e:
+            logger.error(f"Vector search failed: {e}")
+            return None
+
+    def _vector_search_pipeline(self, query_vector, owner_id, index_name, limit, num_candidates,
+                                folder_id=None, folder_name=None, edited_after=None, edited_before=None,
+                                recency_half_life_days=None):
+        # Фильтры применяются внутри $vectorSearch, поэтому поиск идёт только по подходящим чанкам
+        search_filter = self._search_filter(owner_id, folder_id, folder_name, edited_after, edited_before)
+
+        search_limit = limit * RECENCY_RERANK_FACTOR if recency_half_life_days else limit
+
+        pipeline = [
+            {
+                '$vectorSearch': {
+                    'index': index_name,
+                    'path': 'embeddings', 
+                    'queryVector': query_vector,
+                    'numCandidates': max(num_candidates, search_limit),
+                    'limit': search_limit,
+                    'filter': search_filter
+                }
+            },
+            {
+                '$addFields': {
+                    'score': {'$meta': 'vectorSearchScore'}
+                }
+            },
+            {
+                '$project': {
+                    '_id': 0,  # Исключаем поле _id, если оно вам не нужно
+                    'score': 1,  # Явно включаем поле score
+                    # Добавляем все остальные поля
+                    'record_id': 1,
+                    'note_id': 1,
+                    'owner_id': 1, 
+                    'created_date': 1, 
+                    'last_edited_date': 1, 
+                    'folder_id': 1,
+                    'folder_name': 1, 
+                    'title': 1,    
+                    'text': 1
+                }
+            }
+        ]
+
+        if recency_half_life_days:
+            # Переранжирование по свежести: вес от RECENCY_MIN_WEIGHT (старые) до 1 (только что изменённые)
+            now = int(time.time() * 1000)
+            half_life_ms = recency_half_life_days * 24 * 60 * 60 * 1000
+            recency = {'$pow': [0.5, {'$divide': [{'$max': [0, {'$subtract': [now, '$last_edited_date']}]}, half_life_ms]}]}
+            pipeline[2:2] = [
+                {'$addFields': {'score': {'$multiply': [
+                    '$score', {'$add': [RECENCY_MIN_WEIGHT, {'$multiply': [1 - RECENCY_MIN_WEIGHT, recency]}]}
+                ]}}},
+                {'$sort': {'score': -1}},
+                {'$limit': limit}
+            ]
+        return pipeline
+
 # Пример использования
 if __name__ == "__main__":
     db_service = DatabaseService()
@@ -1,16 +1,101 @@
 import base64
+import json
+import logging
+import os
+import threading
+import time
 import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from google.protobuf.message import DecodeError
 from protobuf import versioned_document_pb2, topotext_pb2
 
-def decrypt_note_text(encrypted_base64_text):
-    # Декодируем и распаковываем TextDataEncrypted
+logger = logging.getLogger(__name__)
+
+# Параметры пакетного декодирования в пуле процессов
+DECODE_WORKERS = int(os.getenv('DECODE_WORKERS', str(os.cpu_count() or 1)))
+# Пакеты меньше этого размера декодируем в текущем процессе: пересылка дороже самой работы
+DECODE_INLINE_THRESHOLD_BYTES = int(os.getenv('DECODE_INLINE_THRESHOLD_BYTES', str(256 * 1024)))
+# Желаемый объём данных на одну задачу пула
+DECODE_TASK_TARGET_BYTES = int(os.getenv('DECODE_TASK_TARGET_BYTES', str(1024 * 1024)))
+
+# Ограничения на одну заметку: размер распакованных данных и время декодирования
+NOTE_MAX_DECOMPRESSED_BYTES = int(os.getenv('NOTE_MAX_DECOMPRESSED_BYTES', str(64 * 1024 * 1024)))
+NOTE_DECODE_TIME_BUDGET = float(os.getenv('NOTE_DECODE_TIME_BUDGET', '30'))
+DECOMPRESS_CHUNK_BYTES = 1024 * 1024
+
+_decode_pool = None
+_decode_pool_lock = threading.Lock()
+
+# Счётчики результатов декодирования за время жизни процесса
+decode_metrics = {'decoded': 0, 'skipped_too_large': 0, 'skipped_timeout': 0, 'failed': 0}
+_decode_metrics_lock = threading.Lock()
+
+
+class NoteSkippedError(Exception):
+    """Заметка пропущена: превышен лимит размера или времени декодирования."""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def _check_deadline(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise NoteSkippedError('timeout', "Note decode time budget exceeded")
+
+
+def _decode_deadline(time_budget=None):
+    if time_budget is None:
+        time_budget = NOTE_DECODE_TIME_BUDGET
+    return time.monotonic() + time_budget if time_budget > 0 else None
+
+
+def decompress_payload(encrypted_base64_text, max_output_bytes=None, deadline=None):
+    """
+    Декодирует base64 и потоково распаковывает zlib/gzip, не выходя за max_output_bytes.
+    Защищает процесс синхронизации от огромных заметок и zip-бомб.
+    """
+    if max_output_bytes is None:
+        max_output_bytes = NOTE_MAX_DECOMPRESSED_BYTES
+
     data = base64.b64decode(encrypted_base64_text)
-    
+
     if data[0:2] == b'\x1f\x8b':  # Проверка на Gzip
-        document_data = zlib.decompress(data, zlib.MAX_WBITS | 16)
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
     else:
-        document_data = zlib.decompress(data)
+        decompressor = zlib.decompressobj()
+
+    chunks = []
+    total_bytes = 0
+    buf = data
+    while not decompressor.eof:
+        chunk = decompressor.decompress(buf, DECOMPRESS_CHUNK_BYTES)
+        total_bytes += len(chunk)
+        if total_bytes > max_output_bytes:
+            raise NoteSkippedError('too_large', f"Decompressed note exceeds {max_output_bytes} bytes")
+        chunks.append(chunk)
+        _check_deadline(deadline)
+
+        buf = decompressor.unconsumed_tail
+        if not chunk and not buf:
+            break
+
+    if not decompressor.eof:
+        raise zlib.error("Error -5 while decompressing data: incomplete or truncated stream")
+
+    return b"".join(chunks)
+
+
+def get_decode_metrics():
+    with _decode_metrics_lock:
+        return dict(decode_metrics)
+
+def decrypt_note_text_full(encrypted_base64_text):
+    # Эталонный декодер: разбирает документ целиком со всеми версиями.
+    # Используется для проверки decrypt_note_text на корпусе decrypt_golden.json
+    # Декодируем и распаковываем TextDataEncrypted
+    document_data = decompress_payload(encrypted_base64_text)
 
     try:
         # Декодирование документа с использованием protobuf
@@ -71,6 +156,228 @@ def decrypt_note_text(encrypted_base64_text):
         return None
 
 
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise DecodeError("Truncated varint")
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise DecodeError("Varint is too long")
+
+
+def _last_version_bytes(document_data):
+    """
+    Находит последнее поле Document.version в wire-формате, не разбирая предыдущие версии.
+
+    :return: Сериализованный Version или None, если версий нет
+    """
+    buf = memoryview(document_data)
+    end = len(buf)
+    pos = 0
+    last_version = None
+
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if field_number == 0:
+            raise DecodeError("Invalid field number 0")
+
+        if wire_type == 0:
+            _, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            if field_number == 2:
+                last_version = (pos, pos + length)
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise DecodeError(f"Unsupported wire type: {wire_type}")
+
+    if pos > end:
+        raise DecodeError("Truncated message")
+
+    if last_version is None:
+        return None
+    return bytes(buf[last_version[0]:last_version[1]])
+
+
+def render_formatted_text(text_data, deadline=None):
+    """Собирает текст с форматированием (жирный шрифт, задачи, отступы) за один проход по attributeRun."""
+    string = text_data.string
+    parts = []
+    append = parts.append
+    current_position = 0
+    task_added = False  # Флаг для предотвращения дублирования символа задачи
+
+    for run_index, run in enumerate(text_data.attributeRun):
+        if deadline is not None and run_index % 4096 == 0:
+            _check_deadline(deadline)
+
+        next_position = current_position + run.length
+        text_chunk = string[current_position:next_position]
+        current_position = next_position
+        ends_with_newline = text_chunk.endswith('\n')
+
+        # Префикс абзаца: отступ и, один раз на абзац, чекбокс задачи
+        if run.HasField('paragraphStyle'):
+            paragraph_style = run.paragraphStyle
+            append('    ' * paragraph_style.indent)
+            if paragraph_style.HasField('todo') and not task_added:
+                append('[x] ' if paragraph_style.todo.done else '[ ] ')
+                task_added = True
+
+        if run.fontHints == 1:
+            append('**')
+            append(text_chunk.strip())
+            append('**\n' if ends_with_newline else '**')
+        else:
+            append(text_chunk)
+
+        if ends_with_newline:
+            task_added = False  # Сброс флага после завершения параграфа
+
+    return "".join(parts)
+
+
+def decrypt_note_text(encrypted_base64_text, max_output_bytes=None, time_budget=None):
+    """
+    Декодирует TextDataEncrypted, разбирая только последнюю версию документа.
+    Результат побайтно совпадает с decrypt_note_text_full.
+
+    :raises NoteSkippedError: Если заметка больше max_output_bytes или не уложилась в time_budget секунд
+    """
+    deadline = _decode_deadline(time_budget)
+    document_data = decompress_payload(encrypted_base64_text, max_output_bytes, deadline)
+
+    try:
+        version_data = _last_version_bytes(document_data)
+        if version_data is None:
+            # Документ без версий: полный разбор даёт то же поведение, что и эталонный декодер
+            document = versioned_document_pb2.Document()
+            document.ParseFromString(document_data)
+            version_data = document.version[-1].SerializeToString()
+
+        last_version = versioned_document_pb2.Version()
+        last_version.ParseFromString(version_data)
+
+        text_data = topotext_pb2.String()
+        text_data.ParseFromString(last_version.data)
+
+        _check_deadline(deadline)
+        return render_formatted_text(text_data, deadline)
+
+    except DecodeError as e:
+        print(f"Ошибка декодирования Protobuf: {str(e)}")
+        return None
+
+
+def _decrypt_many(encrypted_base64_texts):
+    """
+    Декодирует список заметок, ошибка одной заметки не мешает остальным.
+
+    :return: Список пар (text, skip_reason), skip_reason равен None при успехе
+    """
+    results = []
+    for encrypted_base64_text in encrypted_base64_texts:
+        try:
+            text = decrypt_note_text(encrypted_base64_text)
+            results.append((text, None if text is not None else 'failed'))
+        except NoteSkippedError as e:
+            logger.warning(f"Skipping note text: {e}")
+            results.append((None, e.reason))
+        except Exception as e:
+            logger.error(f"Failed to decode note text: {e}")
+            results.append((None, 'failed'))
+    return results
+
+
+def _record_decode_metrics(results):
+    with _decode_metrics_lock:
+        for _, skip_reason in results:
+            if skip_reason is None:
+                decode_metrics['decoded'] += 1
+            elif skip_reason == 'failed':
+                decode_metrics['failed'] += 1
+            else:
+                decode_metrics[f'skipped_{skip_reason}'] += 1
+
+
+def _get_decode_pool():
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = ProcessPoolExecutor(max_workers=DECODE_WORKERS)
+        return _decode_pool
+
+
+def _reset_decode_pool():
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is not None:
+            _decode_pool.shutdown(wait=False, cancel_futures=True)
+            _decode_pool = None
+
+
+def _split_by_size(payloads, target_bytes):
+    """Разбивает payloads на последовательные задачи примерно по target_bytes байт."""
+    tasks = []
+    current = []
+    current_bytes = 0
+    for payload in payloads:
+        current.append(payload)
+        current_bytes += len(payload)
+        if current_bytes >= target_bytes:
+            tasks.append(current)
+            current = []
+            current_bytes = 0
+    if current:
+        tasks.append(current)
+    return tasks
+
+
+def decrypt_notes_batch(encrypted_base64_texts):
+    """
+    Декодирует несколько TextDataEncrypted, распределяя работу по пулу процессов.
+
+    :param encrypted_base64_texts: Список значений TextDataEncrypted
+    :return: Список пар (text, skip_reason) в том же порядке. Для пропущенных заметок text равен None,
+             а skip_reason — 'too_large', 'timeout' или 'failed'
+    """
+    payloads = list(encrypted_base64_texts)
+    total_bytes = sum(len(payload) for payload in payloads)
+
+    if DECODE_WORKERS <= 1 or len(payloads) < 2 or total_bytes < DECODE_INLINE_THRESHOLD_BYTES:
+        results = _decrypt_many(payloads)
+        _record_decode_metrics(results)
+        return results
+
+    # Делим работу по объёму данных, а не по количеству заметок
+    target_bytes = max(1, min(DECODE_TASK_TARGET_BYTES, -(-total_bytes // DECODE_WORKERS)))
+    tasks = _split_by_size(payloads, target_bytes)
+
+    try:
+        results = []
+        for task_results in _get_decode_pool().map(_decrypt_many, tasks):
+            results.extend(task_results)
+    except BrokenProcessPool as e:
+        logger.error(f"Decode process pool failed, decoding inline: {e}")
+        _reset_decode_pool()
+        results = _decrypt_many(payloads)
+
+    _record_decode_metrics(results)
+    return results
+
+
 # Пример использования decrypt
 # encrypted_json = {
 #     "fields": {
@@ -91,4 +398,25 @@ def decrypt_note_text(encrypted_base64_text):
 
 
 # note_text = decrypt_note_text(encrypted_json['fields']['TextDataEncrypted']['value'])
-# print(note_text)
\ No newline at end of file
+# print(note_text)
+
+
+def check_golden_corpus(path='decrypt_golden.json'):
+    """Сравнивает оба декодера с эталонными результатами из корпуса."""
+    with open(path, encoding='utf-8') as file:
+        corpus = json.load(file)
+
+    failed = []
+    for case in corpus:
+        for decoder in (decrypt_note_text, decrypt_note_text_full):
+            if decoder(case['payload']) != case['expected']:
+                failed.append(f"{case['name']} ({decoder.__name__})")
+
+    print(f"Checked {len(corpus)} golden notes, {len(failed)} mismatches")
+    for name in failed:
+        print(f"  mismatch: {name}")
+    return not failed
+
+
+if __name__ == "__main__":
+    check_golden_corpus()
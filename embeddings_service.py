@@ -1,12 +1,61 @@
 import os
+import asyncio
+import threading
 import tiktoken
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 from datetime import datetime
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Local cache for tiktoken BPE files, so the encoder loads without a network request after the first download
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tiktoken_cache"))
+
+# The OpenAI client is created on first use, not on import
+_client = None
+_client_lock = threading.Lock()
+# Async client for async_server.py; it is bound to the event loop that first uses it
+_async_client = None
+
+# Параметры эмбеддингов по умолчанию; активный индекс в базе может их переопределить
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-large")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "3072"))
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "8192"))
+
+def get_client():
+    """Return the shared OpenAI client, creating it on first call."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
+
+def get_async_client():
+    """Return the shared AsyncOpenAI client, creating it on first call inside the event loop."""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _async_client
+
+def warm_up(encoding_name: str = "cl100k_base"):
+    """
+    Preload the tokenizer and open a connection to the OpenAI API,
+    so the first request does not pay for initialization.
+    """
+    tiktoken.get_encoding(encoding_name)
+    try:
+        get_client().models.retrieve(EMBEDDING_MODEL)
+    except Exception as e:
+        print(f"An error occurred while warming up the OpenAI connection: {e}")
+
+async def warm_up_async(encoding_name: str = "cl100k_base"):
+    """Async counterpart of warm_up() that opens a connection of the async client."""
+    await asyncio.to_thread(tiktoken.get_encoding, encoding_name)
+    try:
+        await get_async_client().models.retrieve(EMBEDDING_MODEL)
+    except Exception as e:
+        print(f"An error occurred while warming up the OpenAI connection: {e}")
 
 def format_timestamp(timestamp):
     """Convert timestamp to a readable date format."""
@@ -30,7 +79,13 @@ def truncate_text(text: str, max_tokens: int, encoding_name: str = "cl100k_base"
     
     return encoding.decode(tokens)
 
-def create_chunks(note, max_tokens=8192):
+def chunk_metadata(note):
+    """Metadata header that starts every chunk of a note."""
+    metadata = f"Folder: {note['folder_name']}\n"
+    metadata += f"Creation Date: {format_timestamp(note['created_date'])}\n"
+    return metadata
+
+def create_chunks(note, max_tokens=None):
     """
     Create chunks from a note, ensuring each chunk starts with note metadata.
     
@@ -38,8 +93,9 @@ def create_chunks(note, max_tokens=8192):
     :param max_tokens: Maximum number of tokens per chunk
     :return: A list of text chunks
     """
-    metadata = f"Folder: {note['folder_name']}\n"
-    metadata += f"Creation Date: {format_timestamp(note['created_date'])}\n"
+    if max_tokens is None:
+        max_tokens = CHUNK_MAX_TOKENS
+    metadata = chunk_metadata(note)
     metadata_tokens = num_tokens_from_string(metadata)
     
     text = note['text']
@@ -64,32 +120,65 @@ def create_chunks(note, max_tokens=8192):
 
     return chunks
 
-def create_embedding(text, model="text-embedding-3-large"):
+def note_text_from_chunks(note, chunk_texts):
+    """
+    Rebuild note text from its stored chunks by removing the metadata header of each chunk.
+    Used to rechunk notes without fetching them from iCloud again.
+    """
+    metadata = chunk_metadata(note)
+    lines = []
+    for chunk_text in chunk_texts:
+        if chunk_text.startswith(metadata):
+            chunk_text = chunk_text[len(metadata):]
+        lines.append(chunk_text)
+    return '\n'.join(lines)
+
+def create_embedding(text, model=None, dimensions=None):
     """Create an embedding using the OpenAI API."""
     try:
-        response = client.embeddings.create(
-            model=model,
+        response = get_client().embeddings.create(
+            model=model or EMBEDDING_MODEL,
+            input=text,
+            encoding_format="float",
+            dimensions=dimensions or EMBEDDING_DIMENSIONS
+        )
+        return response.data[0].embedding
+    except Exception as e:
+        print(f"An error occurred while creating the embedding: {e}")
+        return None
+
+async def create_embedding_async(text, model=None, dimensions=None):
+    """Create an embedding with the async OpenAI client, without blocking a thread while waiting."""
+    try:
+        response = await get_async_client().embeddings.create(
+            model=model or EMBEDDING_MODEL,
             input=text,
             encoding_format="float",
-            dimensions=3072
+            dimensions=dimensions or EMBEDDING_DIMENSIONS
         )
         return response.data[0].embedding
     except Exception as e:
         print(f"An error occurred while creating the embedding: {e}")
         return None
 
-def process_note(note):
+def process_note(note, model=None, dimensions=None, max_tokens=None, rate_limiter=None):
     """
     Process a note: create chunks if necessary and generate embeddings.
     
     :param note: A dictionary containing note data
+    :param model: Embedding model, defaults to EMBEDDING_MODEL
+    :param dimensions: Embedding dimensions, defaults to EMBEDDING_DIMENSIONS
+    :param max_tokens: Maximum number of tokens per chunk, defaults to CHUNK_MAX_TOKENS
+    :param rate_limiter: Optional limiter whose wait() is called before each API request
     :return: A list of tuples (chunk, embedding)
     """
-    chunks = create_chunks(note)
+    chunks = create_chunks(note, max_tokens)
     results = []
     
     for chunk in chunks:
-        embeddings = create_embedding(chunk)
+        if rate_limiter:
+            rate_limiter.wait()
+        embeddings = create_embedding(chunk, model, dimensions)
         results.append((chunk, embeddings))
         
     return results
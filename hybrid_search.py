@@ -0,0 +1,180 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import embeddings_service
+from search_response import extract_terms, WORD_PATTERN
+
+logger = logging.getLogger(__name__)
+
+# Короткие запросы (имя, код, слово из заголовка) сначала пробуем ответить полнотекстовым поиском
+KEYWORD_QUERY_MAX_TERMS = int(os.getenv('KEYWORD_QUERY_MAX_TERMS', '3'))
+# Минимальный textScore лучшего результата, при котором лексическому ответу можно доверять
+LEXICAL_MIN_SCORE = float(os.getenv('LEXICAL_MIN_SCORE', '1.0'))
+# Константа reciprocal rank fusion
+RRF_K = 60
+
+# Сколько эмбеддингов запросов помним для каждого владельца: повторный запрос не обращается к OpenAI.
+# Кэши владельцев раздельные, поэтому частые запросы одного владельца не вытесняют записи других
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', '32'))
+
+# Общий пул для параллельных запросов к OpenAI и MongoDB во время поиска
+_search_executor = ThreadPoolExecutor(max_workers=int(os.getenv('SEARCH_IO_WORKERS', '8')))
+
+
+_embedding_caches = {}
+_embedding_caches_lock = threading.Lock()
+
+
+def _cached_query_embedding(owner_id, key):
+    with _embedding_caches_lock:
+        cache = _embedding_caches.setdefault(owner_id, OrderedDict())
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    return None
+
+
+def _cache_query_embedding(owner_id, key, query_vector):
+    if query_vector is None or QUERY_EMBEDDING_CACHE_SIZE <= 0:
+        return
+    with _embedding_caches_lock:
+        cache = _embedding_caches.setdefault(owner_id, OrderedDict())
+        cache[key] = query_vector
+        while len(cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def get_query_embedding(owner_id, query_text, model, dimensions):
+    """Эмбеддинг запроса из кэша владельца или из OpenAI. Неудачные запросы не кэшируются."""
+    key = (model, dimensions, query_text)
+    query_vector = _cached_query_embedding(owner_id, key)
+    if query_vector is None:
+        query_vector = embeddings_service.create_embedding(query_text, model, dimensions)
+        _cache_query_embedding(owner_id, key, query_vector)
+    return query_vector
+
+
+async def get_query_embedding_async(owner_id, query_text, model, dimensions):
+    """Асинхронный вариант get_query_embedding с тем же кэшем."""
+    key = (model, dimensions, query_text)
+    query_vector = _cached_query_embedding(owner_id, key)
+    if query_vector is None:
+        query_vector = await embeddings_service.create_embedding_async(query_text, model, dimensions)
+        _cache_query_embedding(owner_id, key, query_vector)
+    return query_vector
+
+
+def is_keyword_query(query_text):
+    """Запрос в кавычках или из нескольких слов — вероятно, поиск конкретного имени, кода или заголовка."""
+    if '"' in query_text:
+        return True
+    return len(WORD_PATTERN.findall(query_text)) <= KEYWORD_QUERY_MAX_TERMS
+
+
+def is_confident_lexical_match(query_text, results):
+    """Лучший лексический результат достаточно сильный и содержит все слова запроса."""
+    if not results or results[0]['score'] < LEXICAL_MIN_SCORE:
+        return False
+    terms = extract_terms(query_text) or set(WORD_PATTERN.findall(query_text.lower()))
+    top_words = set(WORD_PATTERN.findall(f"{results[0]['title']}\n{results[0]['text']}".lower()))
+    return terms <= top_words
+
+
+def reciprocal_rank_fusion(result_lists, limit):
+    """Объединяет несколько ранжированных списков: score = сумма 1 / (RRF_K + rank) по спискам."""
+    fused = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            entry = fused.setdefault(result['record_id'], dict(result, score=0))
+            entry['score'] += 1 / (RRF_K + rank)
+    return sorted(fused.values(), key=lambda result: result['score'], reverse=True)[:limit]
+
+
+def search_notes(db_service, query_text, owner_id, limit=5, recency_half_life_days=None, stream=False, **filters):
+    """
+    Ищет заметки: уверенные ответы на запросы по ключевым словам возвращаются сразу из полнотекстового индекса,
+    остальные объединяют векторный и лексический поиск через reciprocal rank fusion.
+    Если эмбеддинг получить не удалось, возвращаются лексические результаты.
+
+    :param stream: Если лексический поиск ничего не нашёл, вернуть курсор векторного поиска без чтения в список
+    :param filters: folder_id, folder_name, edited_after, edited_before
+    :return: Список (или курсор) результатов или None, если оба вида поиска завершились ошибкой
+    """
+    lexical_future = _search_executor.submit(db_service.lexical_search_notes, query_text, owner_id, limit, **filters)
+
+    if is_keyword_query(query_text):
+        lexical_results = lexical_future.result()
+        if is_confident_lexical_match(query_text, lexical_results):
+            logger.info("Search answered from the full-text index")
+            return lexical_results
+
+    # Модель и размерность должны совпадать с активным векторным индексом
+    active_index = db_service.get_active_index()
+    query_vector = get_query_embedding(owner_id, query_text, active_index['embedding_model'], active_index['dimensions'])
+    lexical_results = lexical_future.result()
+
+    if query_vector is None:
+        logger.warning("Embedding is unavailable, falling back to full-text search")
+        return lexical_results
+
+    vector_results = db_service.vector_search_notes(
+        query_vector=query_vector,
+        owner_id=owner_id,
+        limit=limit,
+        recency_half_life_days=recency_half_life_days,
+        stream=stream,
+        **filters
+    )
+
+    # Объединять не с чем: результаты векторного поиска отдаются в порядке курсора
+    if stream and not lexical_results and vector_results is not None:
+        return vector_results
+
+    if vector_results is None and lexical_results is None:
+        return None
+    return reciprocal_rank_fusion([vector_results or [], lexical_results or []], limit)
+
+
+async def search_notes_async(db_service, query_text, owner_id, limit=5, recency_half_life_days=None, **filters):
+    """
+    Асинхронный вариант search_notes для async_server.py: лексический поиск, эмбеддинг запроса
+    и векторный поиск выполняются в цикле событий без выделения потока на запрос.
+
+    :return: Список результатов или None, если оба вида поиска завершились ошибкой
+    """
+    lexical_task = asyncio.create_task(db_service.lexical_search_notes_async(query_text, owner_id, limit, **filters))
+    try:
+        if is_keyword_query(query_text):
+            lexical_results = await lexical_task
+            if is_confident_lexical_match(query_text, lexical_results):
+                logger.info("Search answered from the full-text index")
+                return lexical_results
+
+        active_index = await db_service.get_active_index_async()
+        query_vector = await get_query_embedding_async(
+            owner_id, query_text, active_index['embedding_model'], active_index['dimensions']
+        )
+        if query_vector is None:
+            logger.warning("Embedding is unavailable, falling back to full-text search")
+            return await lexical_task
+
+        vector_results, lexical_results = await asyncio.gather(
+            db_service.vector_search_notes_async(
+                query_vector=query_vector,
+                owner_id=owner_id,
+                limit=limit,
+                recency_half_life_days=recency_half_life_days,
+                **filters
+            ),
+            lexical_task
+        )
+    finally:
+        # Клиент отключился или поиск упал: лексический запрос больше не нужен
+        lexical_task.cancel()
+
+    if vector_results is None and lexical_results is None:
+        return None
+    return reciprocal_rank_fusion([vector_results or [], lexical_results or []], limit)
@@ -0,0 +1,113 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Срок аренды лидера (в секундах): если лидер не продлил её за это время, лидером может стать другой процесс
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', '30'))
+
+
+class LeaseLostError(Exception):
+    """Аренда, под которой выполнялась задача, истекла или перешла к другому процессу."""
+
+
+class LeaseFence:
+    """Держатель и эпоха аренды, под которыми воркер забрал задачу. check() вызывается перед каждой записью."""
+
+    def __init__(self, db_service, name, holder, epoch):
+        self.db_service = db_service
+        self.name = name
+        self.holder = holder
+        self.epoch = epoch
+
+    def check(self):
+        if not self.db_service.holds_lease(self.name, self.holder, self.epoch):
+            raise LeaseLostError(f"Lease {self.name} epoch {self.epoch} is no longer held by {self.holder}")
+
+
+class LeaderLease:
+    """
+    Выбор лидера среди процессов через аренду в коллекции leases (MongoDB).
+    Лидер продлевает аренду каждые ttl / 3 секунд; on_acquired и on_lost вызываются из потока аренды
+    при получении и потере лидерства.
+    """
+
+    def __init__(self, db_service, name, ttl=LEADER_LEASE_TTL, on_acquired=None, on_lost=None):
+        self.db_service = db_service
+        self.name = name
+        self.ttl = ttl
+        self.on_acquired = on_acquired
+        self.on_lost = on_lost
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self.epoch = None
+        self.renewed_at = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        logger.info(f"Competing for lease {self.name} as {self.holder}")
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name=f'lease-{self.name}', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.is_leader:
+            self._set_leader(False)
+            try:
+                self.db_service.release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.error(f"Failed to release lease {self.name}: {e}")
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                epoch = self.db_service.acquire_lease(self.name, self.holder, self.ttl)
+                if epoch is not None:
+                    self.renewed_at = time.monotonic()
+                    if self.is_leader and epoch != self.epoch:
+                        # Аренда истекла до продления: задачи прежней эпохи отсечены, начинаем новую
+                        self._set_leader(False)
+                    self.epoch = epoch
+                self._set_leader(epoch is not None)
+            except Exception as e:
+                logger.error(f"Failed to renew lease {self.name}: {e}")
+                # Без связи с базой считаем себя лидером, только пока не истёк срок последней аренды
+                if self.is_leader and time.monotonic() - self.renewed_at >= self.ttl:
+                    self._set_leader(False)
+
+            self.stop_event.wait(self.ttl / 3)
+
+    def fence(self):
+        """Ограждение текущей эпохи аренды или None, если процесс не лидер."""
+        if not self.is_leader:
+            return None
+        return LeaseFence(self.db_service, self.name, self.holder, self.epoch)
+
+    def _set_leader(self, is_leader):
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        if is_leader:
+            logger.info(f"Acquired lease {self.name}")
+            callback = self.on_acquired
+        else:
+            logger.warning(f"Lost lease {self.name}")
+            callback = self.on_lost
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(f"Lease {self.name} callback failed: {e}")
+                if is_leader:
+                    # Повторим вызов on_acquired при следующем продлении аренды
+                    self.is_leader = False
@@ -2,12 +2,18 @@ import os
 import requests
 import json
 import base64
+import hashlib
 import logging
+from urllib.parse import quote
 from icloudpy import ICloudPyService
 from icloudpy.exceptions import ICloudPyFailedLoginException
 from dotenv import load_dotenv
-from decrypt import decrypt_note_text
+from decrypt import decrypt_note_text, decrypt_notes_batch
+from auth_broker import auth_broker
+from leader_lease import LeaseLostError
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Настройка логирования
 # logging.basicConfig(level=logging.DEBUG)
@@ -18,48 +24,140 @@ load_dotenv()
 
 ICLOUD_USERNAME = os.getenv('ICLOUD_USERNAME')
 ICLOUD_PASSWORD = os.getenv('ICLOUD_PASSWORD')
+# Пул принимающих аккаунтов: JSON-список [{"username": ..., "password": ...}].
+# Без него используется один аккаунт ICLOUD_USERNAME
+ICLOUD_ACCOUNTS = json.loads(os.getenv('ICLOUD_ACCOUNTS') or 'null') or [{'username': ICLOUD_USERNAME, 'password': ICLOUD_PASSWORD}]
+ICLOUD_ACCOUNT_PASSWORDS = {account['username']: account['password'] for account in ICLOUD_ACCOUNTS}
+# Аккаунт для задач и зон, сохранённых до появления пула
+DEFAULT_ICLOUD_ACCOUNT = ICLOUD_ACCOUNTS[0]['username']
 SERVER_KEY = os.getenv('SERVER_KEY', '')
 SERVER_URL = os.getenv('SERVER_URL', 'http://localhost:8080')
+# Сколько зон обрабатываем параллельно и сколько запросов в секунду отправляем в CloudKit
+ZONE_FETCH_WORKERS = int(os.getenv('ZONE_FETCH_WORKERS', '4'))
+CLOUDKIT_MAX_RPS = float(os.getenv('CLOUDKIT_MAX_RPS', '5'))
+# Сессия iCloud обновляется заранее: не реже чем раз в ICLOUD_SESSION_REFRESH_INTERVAL секунд
+# и когда до истечения её cookie осталось меньше ICLOUD_SESSION_EXPIRY_MARGIN секунд
+ICLOUD_SESSION_REFRESH_INTERVAL = float(os.getenv('ICLOUD_SESSION_REFRESH_INTERVAL', str(6 * 60 * 60)))
+ICLOUD_SESSION_EXPIRY_MARGIN = float(os.getenv('ICLOUD_SESSION_EXPIRY_MARGIN', str(24 * 60 * 60)))
 
-def authenticate_icloud():
-    logger.debug(f"Attempting to authenticate with username: {ICLOUD_USERNAME}")
-    
-    try:
-        api = ICloudPyService(ICLOUD_USERNAME, ICLOUD_PASSWORD)
-        
-        if api.requires_2fa:
-            logger.info("Two-factor authentication required.")
-            
-            # Ожидаем ввода кода пользователем через веб-интерфейс
-            auth_url = f"{SERVER_URL}/icloud_auth?key={SERVER_KEY}"
-            logger.info(f"Please enter the verification code at: {auth_url}")
-            
-            # Ожидаем ввода кода
-            code = None
-            start_time = time.time()
-            while not code and (time.time() - start_time) < 300:  # Ждем максимум 5 минут
-                response = requests.get(f"{SERVER_URL}/icloud_auth_status?key={SERVER_KEY}")
-                if response.status_code == 200:
-                    data = response.json()
-                    code = data.get('code')
-                    logger.debug(f"Auth status success, 2FA code: {response.text}")
-                if not code:
-                    time.sleep(5)  # Пауза перед следующей проверкой
-            
-            if not code:
-                raise ICloudPyFailedLoginException("Timeout waiting for verification code")
-            
-            result = api.validate_2fa_code(code)
-            logger.debug(f"2FA code validation result: {result}")
-
-            if not result:
-                raise ICloudPyFailedLoginException("Failed to verify 2FA code")
-
-        logger.debug("Authentication successful")
-        return api
-    except ICloudPyFailedLoginException as e:
-        logger.error(f"Login failed: {str(e)}")
-        return None
+
+class RateLimiter:
+    """Ограничивает частоту запросов, общий для всех потоков."""
+
+    def __init__(self, max_per_second):
+        self.interval = 1.0 / max_per_second if max_per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# Лимит CloudKit у каждого аккаунта свой, поэтому и ограничитель свой для каждого dsid
+_cloudkit_rate_limiters = {}
+_cloudkit_rate_limiters_lock = threading.Lock()
+
+
+def get_cloudkit_rate_limiter(dsid):
+    with _cloudkit_rate_limiters_lock:
+        if dsid not in _cloudkit_rate_limiters:
+            _cloudkit_rate_limiters[dsid] = RateLimiter(CLOUDKIT_MAX_RPS)
+        return _cloudkit_rate_limiters[dsid]
+
+# Текущие сессии iCloud по аккаунтам, общие для всех синхронизаций процесса
+_icloud_sessions_lock = threading.Lock()
+_icloud_sessions = {}
+
+
+def _get_icloud_session(account):
+    with _icloud_sessions_lock:
+        if account not in _icloud_sessions:
+            _icloud_sessions[account] = {'api': None, 'refreshed_at': 0, 'lock': threading.Lock()}
+        return _icloud_sessions[account]
+
+
+def session_expires_in(api):
+    """Сколько секунд осталось до истечения ближайшей cookie сессии или None, если срок не указан."""
+    expires = [cookie.expires for cookie in api.session.cookies if cookie.expires]
+    return min(expires) - time.time() if expires else None
+
+
+def session_refresh_due(refreshed_at, api):
+    if time.time() - refreshed_at >= ICLOUD_SESSION_REFRESH_INTERVAL:
+        return True
+    expires_in = session_expires_in(api)
+    return expires_in is not None and expires_in < ICLOUD_SESSION_EXPIRY_MARGIN
+
+
+def complete_2fa(api, account):
+    """Ждёт код подтверждения из /submit_code и подтверждает вход."""
+    logger.info(f"Two-factor authentication required for {account}.")
+
+    # Ожидаем ввода кода пользователем через веб-интерфейс
+    auth_url = f"{SERVER_URL}/icloud_auth?key={SERVER_KEY}&account={quote(account)}"
+    logger.info(f"Please enter the verification code at: {auth_url}")
+
+    code = auth_broker.wait_for_code(account)
+    if not code:
+        raise ICloudPyFailedLoginException("Timeout waiting for verification code")
+
+    result = api.validate_2fa_code(code)
+    logger.debug(f"2FA code validation result: {result}")
+
+    if not result:
+        raise ICloudPyFailedLoginException("Failed to verify 2FA code")
+
+    # Доверенная сессия позволяет обновлять токен без повторного ввода кода
+    if not api.is_trusted_session:
+        api.trust_session()
+
+
+def authenticate_icloud(account=None):
+    """
+    Возвращает сессию аккаунта iCloud (по умолчанию DEFAULT_ICLOUD_ACCOUNT). Сессия переиспользуется
+    между синхронизациями и обновляется заранее, пока токен ещё действителен;
+    если Apple запросит код 2FA, он ожидается через auth_broker.
+    """
+    account = account or DEFAULT_ICLOUD_ACCOUNT
+    logger.debug(f"Attempting to authenticate with username: {account}")
+    session = _get_icloud_session(account)
+
+    with session['lock']:
+        try:
+            api = session['api']
+            if api is None:
+                api = ICloudPyService(account, ICLOUD_ACCOUNT_PASSWORDS[account])
+                session['refreshed_at'] = time.time()
+            elif session_refresh_due(session['refreshed_at'], api):
+                logger.info("Refreshing iCloud session ahead of expiry")
+                api.authenticate(force_refresh=True)
+                session['refreshed_at'] = time.time()
+            else:
+                # Проверка токена; если он отозван, выполняется новый вход
+                api.authenticate()
+
+            if api.requires_2fa:
+                complete_2fa(api, account)
+
+            session['api'] = api
+            logger.debug("Authentication successful")
+            return api
+        except ICloudPyFailedLoginException as e:
+            logger.error(f"Login failed: {str(e)}")
+            session['api'] = None
+            return None
+        except Exception as e:
+            # Сетевая ошибка или ошибка ответа iCloud: состояние сессии неизвестно, следующий вход начнётся заново
+            logger.error(f"Authentication failed: {str(e)}")
+            session['api'] = None
+            return None
 
 
 # def authenticate_icloud():
@@ -167,6 +265,7 @@ def setup_headers(api: ICloudPyService):
 def get_zones(dsid, headers):
     """Получить список всех shared зон (папок)."""
     url = f'https://p140-ckdatabasews.icloud.com/database/1/com.apple.notes/production/shared/zones/list?dsid={dsid}'
+    get_cloudkit_rate_limiter(dsid).wait()
     response = requests.get(url, headers=headers)
     
     logger.debug(f"Zones Response Status Code: {response.status_code}")
@@ -178,7 +277,11 @@ def get_zones(dsid, headers):
         response.raise_for_status()
 
 def get_zone_changes(zone_id, owner_record_name, dsid, headers):
-    """Получить изменения в конкретной зоне, включая заметки."""
+    """
+    Получить изменения в конкретной зоне, включая заметки и удалённые записи.
+
+    :return: Пара (records, more_coming); more_coming=True, если CloudKit вернул зону не целиком
+    """
     url = f'https://p140-ckdatabasews.icloud.com/database/1/com.apple.notes/production/shared/changes/zone?dsid={dsid}'
     payload = {
         "zones": [{
@@ -189,11 +292,12 @@ def get_zone_changes(zone_id, owner_record_name, dsid, headers):
             },
             "desiredKeys": [
                 "TitleEncrypted", "SnippetEncrypted", "FirstAttachmentUTIEncrypted",
-                "FirstAttachmentThumbnail", "CreationDate", "ModificationDate"
+                "FirstAttachmentThumbnail", "CreationDate", "ModificationDate", "Deleted"
             ],
             "desiredRecordTypes": ["Note"]
         }]
     }
+    get_cloudkit_rate_limiter(dsid).wait()
     response = requests.post(url, headers=headers, json=payload)
     
     logger.debug(f"Zone Changes Response Status Code: {response.status_code}")
@@ -201,21 +305,21 @@ def get_zone_changes(zone_id, owner_record_name, dsid, headers):
     # Убедимся, что директория для логов существует
     os.makedirs('logs', exist_ok=True)
     
-    with open(f'logs/zone_changes_logs.json', 'w', encoding='utf-8') as file:
+    with open(f'logs/zone_changes_logs_{zone_id}.json', 'w', encoding='utf-8') as file:
         json.dump(response.json(), file, ensure_ascii=False, indent=4)
     
     if response.status_code == 200:
         # return response.json().get('records', [])
         records = []
+        more_coming = False
         for zone in response.json().get('zones', []):
             zone_records = zone.get('records', [])
             records.extend(zone_records)
+            more_coming = more_coming or zone.get('moreComing', False)
         
-        if records:
-            return records
-        else:
+        if not records:
             logger.warning("No 'records' found in the response.")
-            return []
+        return records, more_coming
     else:
         response.raise_for_status()
 
@@ -265,10 +369,11 @@ def get_folder_name(folder_id, zone_id, owner_record_name, dsid, headers):
             "ownerRecordName": owner_record_name
         }
     }
+    get_cloudkit_rate_limiter(dsid).wait()
     response = requests.post(url, headers=headers, json=payload)
     
     # Логируем ответ в файл
-    with open('logs/folder_name_response.json', 'w', encoding='utf-8') as log_file:
+    with open(f'logs/folder_name_response_{zone_id}.json', 'w', encoding='utf-8') as log_file:
         json.dump(response.json(), log_file, ensure_ascii=False, indent=4)
     
     if response.status_code == 200:
@@ -290,11 +395,12 @@ def get_note_details(record_name, zone_id, owner_record_name, dsid, headers):
             "ownerRecordName": owner_record_name
         }
     }
+    get_cloudkit_rate_limiter(dsid).wait()
     response = requests.post(url, headers=headers, json=payload)
     
     logger.debug(f"Note Details Response Status Code: {response.status_code}")
     # logger.debug(f"Note Details Response Content: {response.text}")
-    with open(f'logs/note_details_logs.json', 'w', encoding='utf-8') as file:
+    with open(f'logs/note_details_logs_{zone_id}.json', 'w', encoding='utf-8') as file:
         json.dump(response.json(), file, ensure_ascii=False, indent=4)
     
     if response.status_code == 200:
@@ -303,12 +409,20 @@ def get_note_details(record_name, zone_id, owner_record_name, dsid, headers):
         response.raise_for_status()
 
 
-def process_record(record, zone_id, owner_record_name, dsid, headers):
+def get_payload_hash(encrypted_text):
+    """Хеш TextDataEncrypted, по которому определяем, менялся ли текст заметки."""
+    return hashlib.sha256(encrypted_text.encode('utf-8')).hexdigest()
+
+
+def process_record(record, zone_id, owner_record_name, dsid, headers, text=None, text_unchanged=False):
     fields = record['fields']
     
     title = base64.b64decode(fields['TitleEncrypted']['value']).decode('utf-8')
     
-    text = decrypt_note_text(fields['TextDataEncrypted']['value'])
+    # Текст может быть уже декодирован пакетно через decrypt_notes_batch.
+    # Если текст не менялся, не декодируем его вовсе: обновятся только метаданные
+    if text is None and not text_unchanged:
+        text = decrypt_note_text(fields['TextDataEncrypted']['value'])
     
     # Получение информации о папке
     folder = fields['Folders']['value'][0]
@@ -326,41 +440,181 @@ def process_record(record, zone_id, owner_record_name, dsid, headers):
         'last_edited_date': record['modified']['timestamp'],
         'folder_id': folder_id,
         'folder_name': folder_name, 
-        'owner_id': owner_id
+        'owner_id': owner_id,
+        'zone_id': zone_id,
+        'payload_hash': get_payload_hash(fields['TextDataEncrypted']['value']),
+        'text_unchanged': text_unchanged
     }
     
     return processed_note
 
 
-def get_notes_list(api, synced_notes_edited_dates={}):
+def is_deleted_record(record):
+    """Удалённая запись (tombstone) или заметка в «Недавно удалённых»."""
+    if record.get('deleted'):
+        return True
+    return bool(record.get('fields', {}).get('Deleted', {}).get('value'))
+
+
+def get_zone_snapshot(zone_id, owner_record_name, dsid, headers):
+    """
+    Получить текущее состояние зоны: живые заметки и удалённые записи.
+
+    :return: Пара (live_notes, snapshot), где snapshot описывает зону для сверки индекса
+    """
+    records, more_coming = get_zone_changes(zone_id, owner_record_name, dsid, headers)
+    live_notes = [record for record in records if not is_deleted_record(record)]
+    snapshot = {
+        'live_note_ids': [record['recordName'] for record in live_notes],
+        'deleted_note_ids': [record['recordName'] for record in records if is_deleted_record(record)],
+        # По неполному ответу нельзя судить, каких заметок в зоне больше нет
+        'complete': not more_coming
+    }
+    return live_notes, snapshot
+
+
+def get_zone_notes(zone, synced_notes_edited_dates, dsid, headers, skipped_notes=None, payload_hashes=None, zone_snapshots=None):
+    """
+    Получить новые и изменённые заметки одной зоны.
+    Заметки, которые не удалось декодировать, добавляются в skipped_notes.
+    Заметки, чей TextDataEncrypted совпадает с payload_hashes, возвращаются без текста с text_unchanged=True.
+    Состояние зоны для удаления мёртвых заметок из индекса сохраняется в zone_snapshots.
+    """
+    zone_id = zone['zoneID']['zoneName']
+    owner_record_name = zone['zoneID']['ownerRecordName']
+    zone_records = []
+    zone_notes = []
+
+    # Получение заметок из зоны
+    notes, snapshot = get_zone_snapshot(zone_id, owner_record_name, dsid, headers)
+    if zone_snapshots is not None:
+        zone_snapshots[zone_id] = snapshot
+
+    for note in notes:
+        note_record_name = note['recordName']
+        modification_date = note['fields']['ModificationDate']['value']
+
+        # Проверяем, нужно ли обновлять эту заметку
+        if note_record_name not in synced_notes_edited_dates or modification_date > synced_notes_edited_dates[note_record_name]:
+            note_details = get_note_details(note_record_name, zone_id, owner_record_name, dsid, headers)
+            zone_records.extend(note_details)
+
+    # Изменились только метаданные (перенос в папку, закрепление): текст не декодируем
+    if payload_hashes:
+        changed_records = []
+        for record in zone_records:
+            if payload_hashes.get(record['recordName']) == get_payload_hash(record['fields']['TextDataEncrypted']['value']):
+                processed_note = process_record(record, zone_id, owner_record_name, dsid, headers, text_unchanged=True)
+                zone_notes.append(processed_note)
+            else:
+                changed_records.append(record)
+        zone_records = changed_records
+
+    # Декодируем тексты всех заметок зоны одним пакетом
+    decoded = decrypt_notes_batch([record['fields']['TextDataEncrypted']['value'] for record in zone_records])
+
+    for record, (text, skip_reason) in zip(zone_records, decoded):
+        if text is None:
+            logger.warning(f"Skipping note {record['recordName']}: {skip_reason}")
+            if skipped_notes is not None:
+                skipped_notes.append({
+                    'record_id': record['recordName'],
+                    'zone_id': zone_id,
+                    'reason': skip_reason,
+                    'payload_size': len(record['fields']['TextDataEncrypted']['value']),
+                    'last_edited_date': record['modified']['timestamp']
+                })
+            continue
+        processed_note = process_record(record, zone_id, owner_record_name, dsid, headers, text=text)
+        zone_notes.append(processed_note)
+
+    return zone_notes
+
+
+def list_shared_zones(api, zone_ids=None):
+    """Возвращает (zones, dsid, headers) для всех shared зон или только для zone_ids."""
+    headers, params = setup_headers(api)
+
+    # Получение списка зон (shared папок)
+    zones = get_zones(params['dsid'], headers)
+    # Синхронизация только указанных зон, например только что принятой папки
+    if zone_ids is not None:
+        zones = [zone for zone in zones if zone['zoneID']['zoneName'] in zone_ids]
+    return zones, params['dsid'], headers
+
+
+def get_zone_snapshots(api, zone_ids=None):
+    """
+    Получить состояние всех зон без загрузки содержимого заметок (для сверки индекса).
+
+    :return: Словарь zone_id -> snapshot (None, если зону получить не удалось) или None при ошибке списка зон
+    """
     try:
-        headers, params = setup_headers(api)
-        
-        # Получение списка зон (shared папок)
-        zones = get_zones(params['dsid'], headers)
-        all_notes = []
+        zones, dsid, headers = list_shared_zones(api, zone_ids)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Failed to list shared zones: {e}")
+        return None
 
-        for zone in zones:
-            zone_id = zone['zoneID']['zoneName']
-            owner_record_name = zone['zoneID']['ownerRecordName']
-            
-            # Получение заметок из зоны
-            notes = get_zone_changes(zone_id, owner_record_name, params['dsid'], headers)
-            
-            for note in notes:
-                note_record_name = note['recordName']
-                modification_date = note['fields']['ModificationDate']['value']
-                
-                # Проверяем, нужно ли обновлять эту заметку
-                if note_record_name not in synced_notes_edited_dates or modification_date > synced_notes_edited_dates[note_record_name]:
-                    note_details = get_note_details(note_record_name, zone_id, owner_record_name, params['dsid'], headers)
-                    
-                    for record in note_details:
-                        processed_note = process_record(record, zone_id, owner_record_name, params['dsid'], headers)
-                        all_notes.append(processed_note)
-        
-        return all_notes
+    zone_snapshots = {zone['zoneID']['zoneName']: None for zone in zones}
+
+    with ThreadPoolExecutor(max_workers=max(1, ZONE_FETCH_WORKERS)) as executor:
+        futures = [
+            (zone['zoneID']['zoneName'], executor.submit(get_zone_snapshot, zone['zoneID']['zoneName'], zone['zoneID']['ownerRecordName'], dsid, headers))
+            for zone in zones
+        ]
 
+        for zone_id, future in futures:
+            try:
+                _, zone_snapshots[zone_id] = future.result()
+            except Exception as e:
+                logger.error(f"Failed to retrieve state of zone {zone_id}: {e}")
+
+    return zone_snapshots
+
+
+def get_notes_list(api, synced_notes_edited_dates={}, skipped_notes=None, payload_hashes=None, zone_ids=None, zone_snapshots=None,
+                   on_zone_notes=None):
+    """
+    :param on_zone_notes: Вызывается со списком заметок каждой зоны, как только она загружена и декодирована
+    """
+    try:
+        zones, dsid, headers = list_shared_zones(api, zone_ids)
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to retrieve notes: {e}")
-        return []
\ No newline at end of file
+        return []
+
+    # Зона, которую не удалось получить, остаётся с None и не сверяется
+    if zone_snapshots is not None:
+        for zone in zones:
+            zone_snapshots[zone['zoneID']['zoneName']] = None
+
+    all_notes = []
+
+    # Зоны обрабатываются параллельно, ошибка одной зоны не теряет результаты остальных
+    with ThreadPoolExecutor(max_workers=max(1, ZONE_FETCH_WORKERS)) as executor:
+        futures = {
+            executor.submit(get_zone_notes, zone, synced_notes_edited_dates, dsid, headers, skipped_notes, payload_hashes, zone_snapshots): zone['zoneID']['zoneName']
+            for zone in zones
+        }
+
+        for future in as_completed(futures):
+            zone_id = futures[future]
+            try:
+                zone_notes = future.result()
+            except Exception as e:
+                logger.error(f"Failed to retrieve notes for zone {zone_id}: {e}")
+                continue
+            try:
+                if on_zone_notes and zone_notes:
+                    on_zone_notes(zone_notes)
+            except LeaseLostError:
+                # Аренду забрал другой процесс: результаты остальных зон ему не нужны
+                for other in futures:
+                    other.cancel()
+                raise
+            except Exception as e:
+                # Заметки зоны всё равно синхронизируются в этом запуске, только без чекпоинта
+                logger.error(f"Failed to save checkpoints for zone {zone_id}: {e}")
+            all_notes.extend(zone_notes)
+
+    return all_notes
@@ -0,0 +1,254 @@
+import argparse
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
+from db_service import DatabaseService, ACTIVE_INDEX_REFRESH_SECONDS
+from embeddings_service import process_note, note_text_from_chunks, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, CHUNK_MAX_TOKENS
+from notes_reader import RateLimiter
+from sync_notes import build_chunk_documents
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Параметры переиндексации по умолчанию
+REINDEX_WORKERS = int(os.getenv('REINDEX_WORKERS', '4'))
+REINDEX_MAX_RPS = float(os.getenv('REINDEX_MAX_RPS', '5'))
+# Сколько раз догоняем изменения, сделанные синхронизацией во время заполнения теневой коллекции
+REINDEX_CATCH_UP_PASSES = 3
+PROGRESS_LOG_EVERY = 50
+
+
+def load_source_notes(collection):
+    """
+    Собирает заметки из чанков коллекции.
+
+    :return: Словарь note_id -> заметка с восстановленным полным текстом
+    """
+    chunks_by_note = {}
+    for chunk in collection.find({}, {'_id': 0, 'embeddings': 0}):
+        note_id = chunk.get('note_id')
+        if note_id is None:
+            # Старые чанки без note_id: у заметки из нескольких чанков record_id и заголовок с суффиксом номера
+            note_id = chunk['record_id']
+            if re.search(r' - \d+$', chunk['title']):
+                note_id = re.sub(r'-\d+$', '', note_id)
+        chunks_by_note.setdefault(note_id, []).append(chunk)
+
+    notes = {}
+    for note_id, chunks in chunks_by_note.items():
+        chunks.sort(key=lambda chunk: int(re.search(r'-(\d+)$', chunk['record_id']).group(1)) if chunk['record_id'] != note_id else 0)
+        first_chunk = chunks[0]
+        note = {
+            'title': re.sub(r' - \d+$', '', first_chunk['title']) if len(chunks) > 1 else first_chunk['title'],
+            'record_id': note_id,
+            'created_date': first_chunk['created_date'],
+            'last_edited_date': first_chunk['last_edited_date'],
+            'folder_id': first_chunk['folder_id'],
+            'folder_name': first_chunk['folder_name'],
+            'owner_id': first_chunk['owner_id'],
+            'zone_id': first_chunk.get('zone_id'),
+            'payload_hash': first_chunk.get('payload_hash')
+        }
+        note['text'] = note_text_from_chunks(note, [chunk['text'] for chunk in chunks])
+        notes[note_id] = note
+    return notes
+
+
+def note_version(note):
+    return (note['last_edited_date'], note['payload_hash'], note['folder_name'])
+
+
+def copy_note(target, note, index, rate_limiter):
+    """Пересчитывает чанки и эмбеддинги заметки и записывает их в теневую коллекцию."""
+    chunks = process_note(note, index['embedding_model'], index['dimensions'], index['max_tokens'], rate_limiter)
+    if any(embeddings is None for _, embeddings in chunks):
+        raise RuntimeError("Failed to create embeddings")
+
+    chunk_documents = build_chunk_documents(note, chunks)
+    target.bulk_write([
+        UpdateOne({'record_id': chunk_data['record_id']}, {'$set': chunk_data}, upsert=True)
+        for chunk_data in chunk_documents
+    ])
+    target.delete_many({'note_id': note['record_id'], 'record_id': {'$nin': [chunk_data['record_id'] for chunk_data in chunk_documents]}})
+
+
+def copy_notes(db_service, target, notes, index, copied, workers, rate_limiter):
+    """Копирует заметки в теневую коллекцию параллельно, записывая прогресс. Возвращает число ошибок."""
+    total = len(notes)
+    processed = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [(note, executor.submit(copy_note, target, note, index, rate_limiter)) for note in notes]
+
+        for note, future in futures:
+            try:
+                future.result()
+                copied[note['record_id']] = note_version(note)
+            except Exception as e:
+                logger.error(f"Failed to reindex note {note['record_id']}: {e}")
+                failed += 1
+            processed += 1
+
+            if processed % PROGRESS_LOG_EVERY == 0 or processed == total:
+                logger.info(f"Reindex progress: {processed}/{total} notes, {failed} failed")
+                db_service.update_reindex_status({'processed': processed, 'total': total, 'failed': failed})
+
+    return failed
+
+
+def copied_versions(target):
+    """Версии заметок, уже записанных в теневую коллекцию."""
+    return {note_id: note_version(note) for note_id, note in load_source_notes(target).items()}
+
+
+def catch_up(db_service, source, target, index, copied, workers, rate_limiter, passes):
+    """
+    Копирует в теневую коллекцию заметки, изменённые в исходной после прошлого прохода, и удаляет исчезнувшие.
+    Проходы повторяются, пока очередной не найдёт изменений, но не больше passes раз.
+
+    :return: Количество заметок, которые не удалось скопировать на последнем проходе
+    """
+    failed = 0
+    for attempt in range(passes):
+        source_notes = load_source_notes(source)
+
+        removed_note_ids = [note_id for note_id in copied if note_id not in source_notes]
+        if removed_note_ids:
+            target.delete_many({'note_id': {'$in': removed_note_ids}})
+            for note_id in removed_note_ids:
+                copied.pop(note_id)
+
+        pending = [note for note_id, note in source_notes.items() if copied.get(note_id) != note_version(note)]
+        if not pending:
+            return 0
+
+        logger.info(f"Reindex pass {attempt + 1}: {len(pending)} notes to copy")
+        failed = copy_notes(db_service, target, pending, index, copied, workers, rate_limiter)
+    return failed
+
+
+def switch_to_shadow(db_service, source, target, index, copied, workers, rate_limiter):
+    """
+    Догоняет изменения, сделанные синхронизацией, пока строился векторный индекс, и сразу после этого
+    переключает активный индекс. Процессы видят переключение в течение ACTIVE_INDEX_REFRESH_SECONDS
+    и до этого могут писать в старую коллекцию, поэтому после паузы делается ещё один проход.
+
+    :return: True, если переключение выполнено
+    """
+    failed = catch_up(db_service, source, target, index, copied, workers, rate_limiter, 1 + REINDEX_CATCH_UP_PASSES)
+    if failed:
+        logger.error(f"Final catch-up failed for {failed} notes, active index is not switched")
+        db_service.update_reindex_status({'status': 'failed'})
+        return False
+
+    db_service.switch_active_index(index)
+    db_service.update_reindex_status({'status': 'switched'})
+
+    time.sleep(ACTIVE_INDEX_REFRESH_SECONDS)
+    failed = catch_up(db_service, source, target, index, copied, workers, rate_limiter, 1)
+    if failed:
+        logger.error(f"{failed} notes written to the previous collection after the switch were not copied, "
+                     f"they will be picked up by the next sync")
+    return True
+
+
+def reindex(db_service, model=None, dimensions=None, max_tokens=None, workers=REINDEX_WORKERS, max_rps=REINDEX_MAX_RPS, switch=True):
+    """
+    Заполняет теневую коллекцию с новыми параметрами эмбеддингов и чанкинга, пока поиск продолжает
+    работать со старой, и по готовности атомарно переключает на неё DatabaseService.
+
+    :return: Описание нового индекса или None, если переиндексация не удалась
+    """
+    source_index = db_service.get_active_index(refresh=True)
+    source = db_service.db[source_index['collection']]
+
+    collection_name = f"notes_{int(time.time())}"
+    index = {
+        'collection': collection_name,
+        'index_name': f"{collection_name}_vector_index",
+        'embedding_model': model or EMBEDDING_MODEL,
+        'dimensions': dimensions or EMBEDDING_DIMENSIONS,
+        'max_tokens': max_tokens or CHUNK_MAX_TOKENS
+    }
+    logger.info(f"Reindexing {source_index['collection']} into {collection_name} with {index}")
+
+    target = db_service.create_shadow_collection(index)
+    db_service.update_reindex_status({
+        'status': 'filling', 'source': source_index, 'target': index,
+        'processed': 0, 'total': 0, 'failed': 0, 'started_at': int(time.time() * 1000)
+    })
+
+    rate_limiter = RateLimiter(max_rps)
+    copied = {}
+    failed = 0
+
+    # Первый проход копирует всё, следующие догоняют изменения синхронизации и повторяют ошибки
+    failed = catch_up(db_service, source, target, index, copied, workers, rate_limiter, 1 + REINDEX_CATCH_UP_PASSES)
+
+    if failed:
+        logger.error(f"Reindex finished with {failed} failed notes, active index is not switched")
+        db_service.update_reindex_status({'status': 'failed'})
+        return None
+
+    db_service.update_reindex_status({'status': 'building_index'})
+    if not db_service.wait_for_search_index(target, index['index_name']):
+        logger.error(f"Vector index {index['index_name']} is not queryable yet, active index is not switched")
+        db_service.update_reindex_status({'status': 'index_not_ready'})
+        return None
+
+    if not switch:
+        db_service.update_reindex_status({'status': 'ready'})
+        logger.info(f"Shadow collection {collection_name} is ready, run 'python reindex.py switch' to activate it")
+        return index
+
+    if not switch_to_shadow(db_service, source, target, index, copied, workers, rate_limiter):
+        return None
+    logger.info(f"Reindex completed, previous collection {source_index['collection']} is kept for rollback")
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zero-downtime re-embedding of notes via shadow collections")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Fill a shadow collection and switch to it")
+    run_parser.add_argument('--model', help="Embedding model")
+    run_parser.add_argument('--dimensions', type=int, help="Embedding dimensions")
+    run_parser.add_argument('--max-tokens', type=int, help="Maximum tokens per chunk")
+    run_parser.add_argument('--workers', type=int, default=REINDEX_WORKERS, help="Parallel embedding workers")
+    run_parser.add_argument('--max-rps', type=float, default=REINDEX_MAX_RPS, help="Embedding requests per second")
+    run_parser.add_argument('--no-switch', action='store_true', help="Fill the shadow collection without switching to it")
+
+    subparsers.add_parser('switch', help="Switch to the shadow collection prepared with --no-switch")
+    subparsers.add_parser('rollback', help="Switch back to the previous collection")
+    subparsers.add_parser('status', help="Show active index and reindex progress")
+    subparsers.add_parser('update-index', help="Update the active vector index definition (filter fields) in place")
+
+    args = parser.parse_args()
+    db_service = DatabaseService()
+
+    if args.command == 'run':
+        reindex(db_service, args.model, args.dimensions, args.max_tokens, args.workers, args.max_rps, switch=not args.no_switch)
+    elif args.command == 'switch':
+        status = db_service.get_reindex_status()
+        if not status or status.get('status') != 'ready':
+            raise SystemExit("No prepared shadow collection to switch to")
+        # Теневая коллекция могла отстать с момента подготовки: догоняем её перед переключением
+        source = db_service.db[status['source']['collection']]
+        target = db_service.db[status['target']['collection']]
+        switch_to_shadow(db_service, source, target, status['target'], copied_versions(target),
+                         REINDEX_WORKERS, RateLimiter(REINDEX_MAX_RPS))
+    elif args.command == 'rollback':
+        db_service.rollback_active_index()
+    elif args.command == 'update-index':
+        db_service.update_vector_index_definition()
+    else:
+        print(f"Active index: {db_service.get_active_index(refresh=True)}")
+        print(f"Reindex status: {db_service.get_reindex_status()}")
+
+    db_service.close_connection()
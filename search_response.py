@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import logging
+from embeddings_service import num_tokens_from_string, truncate_text
+
+logger = logging.getLogger(__name__)
+
+# Сколько токенов всего может занять ответ /search
+SEARCH_RESPONSE_TOKEN_BUDGET = int(os.getenv('SEARCH_RESPONSE_TOKEN_BUDGET', '6000'))
+# Наименьший бюджет, который может попросить клиент: в него помещаются заголовок ответа и хотя бы одна заметка
+SEARCH_RESPONSE_MIN_TOKEN_BUDGET = 256
+# Чанки с таким и большим сходством по словам считаются дубликатами
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# Максимальный размер одного фрагмента заметки
+PASSAGE_MAX_TOKENS = 150
+# Сколько токенов текста заметки, кроме заголовка, должно поместиться, чтобы заметку стоило показывать
+SNIPPET_MIN_TOKENS = 20
+
+METADATA_PREFIXES = ('Folder: ', 'Creation Date: ')
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def extract_terms(text):
+    """Слова запроса, по которым оцениваются фрагменты: без коротких служебных слов, но с числами."""
+    return {word for word in WORD_PATTERN.findall(text.lower()) if len(word) >= 3 or word.isdigit()}
+
+
+def split_metadata(text):
+    """Отделяет заголовок чанка (папка, дата создания) от текста заметки."""
+    lines = text.split('\n')
+    metadata_lines = []
+    while lines and lines[0].startswith(METADATA_PREFIXES):
+        metadata_lines.append(lines.pop(0))
+    return '\n'.join(metadata_lines), '\n'.join(lines)
+
+
+def _shingles(text, size=3):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def is_near_duplicate(shingles, kept_shingles):
+    return any(
+        len(shingles & other) / max(1, len(shingles | other)) >= NEAR_DUPLICATE_THRESHOLD
+        for other in kept_shingles
+    )
+
+
+def drop_near_duplicates(results):
+    """Убирает чанки, почти совпадающие с уже выбранными (результаты отсортированы по убыванию score)."""
+    kept = []
+    kept_shingles = []
+    for result in results:
+        _, body = split_metadata(result['text'])
+        shingles = _shingles(body)
+        if not is_near_duplicate(shingles, kept_shingles):
+            kept.append(result)
+            kept_shingles.append(shingles)
+    return kept
+
+
+def split_passages(body):
+    """Делит текст на фрагменты по абзацам, ограничивая размер фрагмента PASSAGE_MAX_TOKENS."""
+    passages = []
+    current_lines = []
+    current_tokens = 0
+    for line in body.split('\n'):
+        line_tokens = num_tokens_from_string(line + '\n')
+        if current_lines and (not line.strip() or current_tokens + line_tokens > PASSAGE_MAX_TOKENS):
+            passages.append('\n'.join(current_lines))
+            current_lines = []
+            current_tokens = 0
+        if line.strip():
+            current_lines.append(line)
+            current_tokens += line_tokens
+    if current_lines:
+        passages.append('\n'.join(current_lines))
+    return passages
+
+
+def score_passage(passage, query_terms):
+    """Сначала число разных слов запроса во фрагменте, затем общее число совпадений."""
+    words = WORD_PATTERN.findall(passage.lower())
+    matched = [word for word in words if word in query_terms]
+    return len(set(matched)), len(matched)
+
+
+def extract_snippet(text, query_terms, max_tokens):
+    """
+    Возвращает текст чанка, если он укладывается в max_tokens, иначе самые релевантные запросу фрагменты
+    в исходном порядке, разделённые "...". Заголовок чанка сохраняется всегда.
+    Если кроме заголовка помещается меньше SNIPPET_MIN_TOKENS токенов текста, возвращает пустую строку.
+    """
+    if max_tokens <= 0:
+        return ''
+    if num_tokens_from_string(text) <= max_tokens:
+        return text
+
+    metadata, body = split_metadata(text)
+    remaining = max_tokens - num_tokens_from_string(metadata + '\n')
+    if remaining < SNIPPET_MIN_TOKENS:
+        return ''
+    passages = split_passages(body)
+
+    # Если ни одно слово запроса не встретилось, берём начало заметки
+    ranked = sorted(range(len(passages)), key=lambda i: (score_passage(passages[i], query_terms), -i), reverse=True)
+
+    selected = {}
+    for i in ranked:
+        passage_tokens = num_tokens_from_string(passages[i] + '\n...\n')
+        if passage_tokens <= remaining:
+            selected[i] = passages[i]
+            remaining -= passage_tokens
+        elif not selected and remaining > 0:
+            # Первый по релевантности фрагмент не помещается целиком: обрезаем его
+            selected[i] = truncate_text(passages[i], remaining)
+            remaining = 0
+        if remaining <= 0:
+            break
+
+    parts = []
+    previous = None
+    for i in sorted(selected):
+        if parts and i != previous + 1:
+            parts.append('...')
+        parts.append(selected[i])
+        previous = i
+
+    snippet = '\n'.join(parts)
+    return f"{metadata}\n{snippet}" if metadata else snippet
+
+
+def iter_search_response(header, results, query_text, token_budget=None, expected_count=5):
+    """
+    Отдаёт ответ /search по частям: сначала header, затем раздел каждой заметки, как только он готов,
+    укладываясь в token_budget. Неиспользованный бюджет переходит к следующим заметкам.
+
+    Для списка результатов бюджет делится пропорционально score. results может быть и курсором:
+    тогда будущие score неизвестны, и оставшийся бюджет делится поровну на expected_count результатов,
+    а дубликаты отбрасываются по мере чтения.
+    """
+    if token_budget is None:
+        token_budget = SEARCH_RESPONSE_TOKEN_BUDGET
+
+    yield header
+    remaining = token_budget - num_tokens_from_string(header)
+    query_terms = extract_terms(query_text)
+
+    if isinstance(results, list):
+        results = drop_near_duplicates(results)
+        expected_count = len(results)
+    kept_shingles = []
+
+    note_number = 1
+    for index, result in enumerate(results):
+        if remaining <= 0:
+            break
+
+        _, body = split_metadata(result['text'])
+        shingles = _shingles(body)
+        if is_near_duplicate(shingles, kept_shingles):
+            continue
+        kept_shingles.append(shingles)
+
+        section_start = f"**Note {note_number} content:**\n```\n"
+        section_end = "\n```\n\n"
+        wrapper_tokens = num_tokens_from_string(section_start + section_end)
+
+        if isinstance(results, list):
+            remaining_scores = sum(max(other.get('score', 0), 1e-6) for other in results[index:])
+            share = int(remaining * max(result.get('score', 0), 1e-6) / remaining_scores)
+        else:
+            share = remaining // max(1, expected_count - index)
+
+        # Если доли не хватает на текст заметки, заметка пропускается, а её доля остаётся следующим
+        snippet = extract_snippet(result['text'], query_terms, share - wrapper_tokens)
+        if not snippet.strip():
+            continue
+
+        section = f"{section_start}{snippet}{section_end}"
+        section_tokens = num_tokens_from_string(section)
+        if section_tokens > remaining:
+            # Подсчёт по частям может немного расходиться с подсчётом целого текста
+            overflow = section_tokens - remaining
+            snippet = truncate_text(snippet, max(0, num_tokens_from_string(snippet) - overflow - 1))
+            section = f"{section_start}{snippet}{section_end}"
+            section_tokens = num_tokens_from_string(section)
+            if not split_metadata(snippet)[1].strip() or section_tokens > remaining:
+                break
+
+        yield section
+        remaining -= section_tokens
+        note_number += 1
+
+
+def build_search_response(header, results, query_text, token_budget=None):
+    """
+    Собирает текст ответа /search целиком, укладываясь в token_budget.
+    Бюджет делится между найденными чанками пропорционально их score; неиспользованное переходит дальше.
+    """
+    return ''.join(iter_search_response(header, list(results), query_text, token_budget))
+
+
+def iter_ndjson_search_response(header, results, query_text, token_budget=None):
+    """
+    Отдаёт ответ /search построчно в формате NDJSON: {"type": "header"}, затем {"type": "note"} для каждой заметки
+    и завершающий {"type": "end"}. Если поиск упал посреди ответа, последней строкой идёт {"type": "error"}.
+    """
+    try:
+        for index, part in enumerate(iter_search_response(header, results, query_text, token_budget)):
+            yield json.dumps({'type': 'header' if index == 0 else 'note', 'text': part}) + '\n'
+    except Exception as e:
+        logger.error(f"Search failed while streaming results: {e}")
+        yield json.dumps({'type': 'error', 'error': 'Search failed while streaming results'}) + '\n'
+        return
+    yield json.dumps({'type': 'end'}) + '\n'
@@ -1,78 +1,129 @@
-from flask import Flask, request, jsonify, abort, send_file, render_template_string
+from flask import Flask, request, jsonify, abort, send_file, render_template_string, Response, stream_with_context, g
 import embeddings_service
+from search_response import build_search_response, iter_ndjson_search_response
+from hybrid_search import search_notes
 from db_service import DatabaseService
-from datetime import datetime
 from dotenv import load_dotenv
 import os
 import logging
 from flask_apscheduler import APScheduler
-from sync_notes import sync_notes, accept_invite
-import re
+from sync_worker import SyncWorkerPool
+from notes_reader import ICLOUD_ACCOUNT_PASSWORDS, DEFAULT_ICLOUD_ACCOUNT
+from leader_lease import LeaderLease
+from auth_broker import auth_broker
+from tenants import TenantRegistry
+from zone_scheduler import claim_due_zones
+from api_common import (API_KEY, DEFAULT_OWNER_ID, SERVER_KEY, AUTH_PAGE_TEMPLATE, bearer_api_key,
+                        wants_stream, parse_search_request, search_response_header, extract_invite_guid)
+import itertools
+import threading
+import time
+import atexit
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-API_KEY = os.getenv('GPTS_API_KEY')
 IS_TEST_ENV = os.getenv('IS_TEST_ENV', 'false').lower() == 'true'
-SERVER_KEY = os.getenv('SERVER_KEY')
+
+# Ленивый запуск: процесс сразу принимает соединения, а MongoDB, tiktoken, OpenAI и фоновые задачи
+# инициализируются прогревом в отдельном потоке. Готовность сообщает /ready
+LAZY_STARTUP = os.getenv('LAZY_STARTUP', 'false').lower() == 'true'
+# Роль процесса: web — только API (реплики можно масштабировать), sync — воркер и планировщик синхронизации,
+# all — всё вместе. Воркер и планировщик работают только в процессе, который держит аренду лидера
+SERVER_ROLE = os.getenv('SERVER_ROLE', 'all').lower()
+if SERVER_ROLE not in ('all', 'web', 'sync'):
+    raise ValueError(f"Unknown SERVER_ROLE: {SERVER_ROLE}")
+RUNS_SYNC = SERVER_ROLE in ('all', 'sync')
+# Пауза между попытками прогрева, если MongoDB ещё недоступна (в секундах)
+WARM_UP_RETRY_SECONDS = float(os.getenv('WARM_UP_RETRY_SECONDS', '5'))
 
 app = Flask(__name__)
-db_service = DatabaseService()
+db_service = DatabaseService(lazy=LAZY_STARTUP)
+# Код 2FA передаётся через MongoDB, поэтому его можно ввести на любой реплике
+auth_broker.attach(db_service)
+# Ключи API владельцев и ограничения каждого владельца
+tenant_registry = TenantRegistry(db_service, API_KEY, DEFAULT_OWNER_ID)
 
-# Инициализация планировщика
+# Инициализация планировщика; задачи запускаются после прогрева
 scheduler = APScheduler()
 scheduler.init_app(app)
-scheduler.start()
-
-# Глобальная переменная для хранения кода подтверждения
-verification_code = None
-
-# HTML шаблон для страницы ввода кода
-AUTH_PAGE_TEMPLATE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <title>iCloud Authentication</title>
-</head>
-<body>
-    <h2>Enter iCloud Verification Code</h2>
-    <form action="/submit_code" method="post">
-        <input type="text" name="code" placeholder="Enter verification code">
-        <input type="hidden" name="key" value="{{ key }}">
-        <input type="submit" value="Submit">
-    </form>
-</body>
-</html>
-"""
+
+# Один лидер на все процессы: только он запускает задачи по расписанию и забирает задачи из очереди.
+# Задачи помечаются эпохой аренды: после смены лидера прежний воркер прерывает свою задачу на ближайшей
+# проверке аренды, а новый возвращает её в очередь
+leader_lease = LeaderLease(
+    db_service,
+    'sync_leader',
+    on_acquired=lambda: sync_workers.start(),
+    on_lost=lambda: sync_workers.stop(wait=False)
+)
+
+# Фоновые воркеры синхронизации, по одному на принимающий аккаунт iCloud: синхронизации выполняются
+# через очередь и в пределах аккаунта не пересекаются. В роли web они только ставят задачи в очередь,
+# выполняет их процесс с ролью sync
+sync_workers = SyncWorkerPool(db_service, lease=leader_lease)
+
+# При штатной остановке сразу освобождаем аренду, чтобы другой процесс не ждал её истечения
+atexit.register(leader_lease.stop)
+
+warm_up_done = threading.Event()
+
+def warm_up():
+    """Подключение к MongoDB и индексы, кодировщик tiktoken, соединение с OpenAI, затем воркер и планировщик."""
+    started_at = time.monotonic()
+    if not db_service.ready:
+        db_service.warm_up()
+    embeddings_service.warm_up()
+    if RUNS_SYNC:
+        leader_lease.start()
+        if not scheduler.running:
+            scheduler.start()
+    warm_up_done.set()
+    logger.info(f"Warm-up completed in {time.monotonic() - started_at:.2f}s")
+
+def warm_up_in_background():
+    while not warm_up_done.is_set():
+        try:
+            warm_up()
+        except Exception as e:
+            logger.error(f"Warm-up failed, retrying in {WARM_UP_RETRY_SECONDS}s: {e}")
+            time.sleep(WARM_UP_RETRY_SECONDS)
+
+if LAZY_STARTUP:
+    threading.Thread(target=warm_up_in_background, name='warm-up', daemon=True).start()
+else:
+    warm_up()
 
 @app.route('/icloud_auth')
 def server_auth():
     key = request.args.get('key')
     if key != SERVER_KEY:
         abort(401, description="Unauthorized")
-    return render_template_string(AUTH_PAGE_TEMPLATE, key=key)
+    # Ссылка из лога входа указывает аккаунт, который ждёт код
+    account = request.args.get('account') or DEFAULT_ICLOUD_ACCOUNT
+    if account not in ICLOUD_ACCOUNT_PASSWORDS:
+        abort(400, description="Unknown iCloud account")
+    return render_template_string(AUTH_PAGE_TEMPLATE, key=key, account=account)
 
 @app.route('/submit_code', methods=['POST'])
 def submit_code():
-    global verification_code
     key = request.form.get('key')
     if key != SERVER_KEY:
         abort(401, description="Unauthorized")
-    verification_code = request.form.get('code')
+    account = request.form.get('account') or DEFAULT_ICLOUD_ACCOUNT
+    if account not in ICLOUD_ACCOUNT_PASSWORDS:
+        abort(400, description="Unknown iCloud account")
+    # Ожидающий вход в iCloud продолжается сразу после передачи кода
+    auth_broker.submit_code(request.form.get('code'), account)
     return "Code submitted successfully"
 
-@app.route('/icloud_auth_status')
-def icloud_auth_status():
-    key = request.args.get('key')
-    if key != SERVER_KEY:
-        abort(401, description="Unauthorized")
-    global verification_code
-    if verification_code:
-        code = verification_code
-        verification_code = None  # Сбрасываем код после получения
-        return jsonify({"code": code})
-    return jsonify({"code": None})
+@app.route('/ready', methods=['GET'])
+def readiness():
+    """Проверка готовности для балансировщика: 503, пока не завершён прогрев."""
+    if warm_up_done.is_set():
+        return jsonify({'status': 'ready'})
+    return jsonify({'status': 'warming_up'}), 503
 
 @app.route('/privacy', methods=['GET'])
 def privacy_policy():
@@ -89,47 +140,84 @@ from flask import request, abort
 def require_api_key(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        if auth_header != f"Bearer {API_KEY}":
+        api_key = bearer_api_key(request.headers.get('Authorization'))
+        try:
+            tenant = tenant_registry.resolve(api_key)
+        except Exception as e:
+            logger.error(f"Failed to resolve API key: {e}")
+            abort(503, description="Service unavailable")
+        if tenant is None:
             abort(401, description="Unauthorized: Invalid API key")
+        # Владелец заметок, к которым относится ключ
+        g.tenant = tenant
         return f(*args, **kwargs)
     return decorated_function
 
 @app.route('/search', methods=['POST'])
 @require_api_key
 def search():
-    data = request.json
+    # Ограничения владельца: один активный пользователь не должен занимать весь сервер
+    limits = tenant_registry.limits_for(g.tenant)
+    refusal = limits.try_acquire()
+    if refusal:
+        return jsonify({'error': refusal}), 429
 
-    # Проверяем, что поле search_text присутствует в запросе
-    if 'search_query' not in data:
-        return jsonify({'error': 'Missing search_text parameter'}), 400
+    try:
+        response = run_search(request.json, g.tenant['owner_id'])
+    except Exception:
+        limits.release()
+        raise
 
-    query_text = data['search_query']
-    max_tokens = 8192
-    num_tokens = embeddings_service.num_tokens_from_string(query_text)
+    if isinstance(response, Response) and response.is_streamed:
+        # Слот занят, пока клиент читает потоковый ответ
+        response.call_on_close(limits.release)
+    else:
+        limits.release()
+    return response
 
-    # Если текст длиннее, чем 8192 токена, обрезаем его
-    if num_tokens > max_tokens:
-        query_text = embeddings_service.truncate_text(query_text, max_tokens)
+def run_search(data, owner_id):
+    params, error = parse_search_request(data)
+    if error:
+        return jsonify({'error': error}), 400
+    query_text = params['query_text']
+    token_budget = params['token_budget']
 
-    # Получаем эмбеддинги для текста
-    query_vector = embeddings_service.create_embedding(query_text)
+    stream = wants_stream(data, request.headers.get('Accept'))
 
-    # Хардкод владельца заметок, по которым происходит поиск
-    # Позже можно будет заменить owner_id на параметр запроса или извлекать его из авторизации
-    owner_id = "_5e1e01c1b9373143f359de4bd060d2fd"
-    
-    # Выполняем векторный поиск
-    results = db_service.vector_search_notes(query_vector=query_vector, owner_id=owner_id)
+    # Выполняем поиск: лексический для уверенных запросов по ключевым словам, иначе гибридный
+    results = search_notes(
+        db_service,
+        query_text,
+        owner_id,
+        folder_id=params['folder_id'],
+        folder_name=params['folder_name'],
+        edited_after=params['edited_after'],
+        edited_before=params['edited_before'],
+        recency_half_life_days=params['recency_half_life_days'],
+        stream=stream
+    )
+
+    if results is not None and not isinstance(results, list):
+        # Курсор: читаем первый результат, чтобы вернуть 404 до начала потокового ответа
+        try:
+            first_result = next(results, None)
+        except Exception as e:
+            logger.error(f"Vector search failed: {e}")
+            first_result = None
+        results = itertools.chain([first_result], results) if first_result is not None else None
 
     if not results:
         return jsonify({'error': 'No results found or an error occurred'}), 404
 
     # Форматируем результаты в текстовый ответ
-    response_text = f"""Below is a list of notes found for different dates. Newer ones are more important, and information in older notes from more than a month ago may already be outdated. Current date is {datetime.now().strftime('%d %B %Y, %H:%M')}. Use these notes to craft the most helpful response to the query. If the question was about the present or future make sure to clarify that this is how you noted it earlier. \n\n"""
-    
-    for i, result in enumerate(results, start=1):
-        response_text += f"""**Note {i} content:**\n```\n{result['text']}\n```\n\n"""
+    header = search_response_header()
+
+    if stream:
+        # Заголовок и заметки уходят клиенту по мере форматирования, без сборки всего ответа в памяти
+        return Response(stream_with_context(iter_ndjson_search_response(header, results, query_text, token_budget)),
+                        mimetype='application/x-ndjson')
+
+    response_text = build_search_response(header, results, query_text, token_budget)
 
     return jsonify({'response': response_text})
 
@@ -146,34 +234,79 @@ def accept_shared_folder_route():
         return jsonify({'error': 'Missing url parameter'}), 400
     
     url = data['url']
-    guid = re.search(r'([a-zA-Z0-9]+)$', url)
+    guid = extract_invite_guid(url)
     
     if not guid:
         logger.error(f"Invalid URL format: {url}")
         return jsonify({'error': 'Invalid URL format'}), 400
     
-    guid = guid.group(1)
     logger.debug(f"Extracted GUID: {guid}")
     
     try:
-        result = accept_invite(db_service, guid)
-        logger.debug(f"Result from accept_invite: {result}")
-        return jsonify({'message': f'Shared folder invitation processed for GUID: {guid}'}), 200
+        # Приглашение принимается в фоне, клиент проверяет статус задачи по job_id
+        # Приглашение принимает наименее загруженный аккаунт пула
+        job_id = sync_workers.enqueue_accept_invite(guid, g.tenant['owner_id'])
+        logger.debug(f"Queued sync job {job_id} for GUID: {guid}")
+        return jsonify({
+            'message': f'Shared folder invitation queued for GUID: {guid}',
+            'job_id': job_id,
+            'status_url': f'/sync_jobs/{job_id}'
+        }), 202
     except Exception as e:
-        logger.exception(f"Error processing shared folder invitation: {str(e)}")
+        logger.exception(f"Error queueing shared folder invitation: {str(e)}")
         return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
 
+@app.route('/sync_jobs/<job_id>', methods=['GET'])
+@require_api_key
+def sync_job_status(job_id):
+    # Задачи других владельцев не отличаются от несуществующих
+    job = db_service.get_sync_job(job_id, g.tenant['owner_id'])
+    if not job:
+        return jsonify({'error': 'Sync job not found'}), 404
+    return jsonify(job)
+
 
-# Функция для синхронизации
-@scheduler.task('cron', id='do_sync', hour='*') # minute='*/2')
+# Полная синхронизация находит новые зоны и пересчитывает расписание всех зон
+@scheduler.task('cron', id='do_sync', hour='*/6')
 def scheduled_sync():
+    if not leader_lease.is_leader:
+        return
+    with app.app_context():
+        job_ids = sync_workers.enqueue_full_syncs()
+        app.logger.info(f"Scheduled sync queued as jobs {job_ids}")
+
+# Адаптивный опрос: раз в минуту синхронизируем зоны, у которых наступило время опроса
+@scheduler.task('interval', id='do_zone_sync', minutes=1)
+def scheduled_zone_sync():
+    if not leader_lease.is_leader:
+        return
+    with app.app_context():
+        zones = claim_due_zones(db_service)
+        if zones:
+            job_ids = sync_workers.enqueue_zone_syncs(zones)
+            app.logger.info(f"Sync of {len(zones)} due zones queued as jobs {job_ids}")
+
+# Периодическая сверка индекса: удаление заметок, пропавших в iCloud, и папок без доступа
+@scheduler.task('cron', id='do_reconcile', hour='4', minute='30')
+def scheduled_reconcile():
+    if not leader_lease.is_leader:
+        return
+    with app.app_context():
+        job_ids = sync_workers.enqueue_reconciles()
+        app.logger.info(f"Scheduled reconciliation queued as jobs {job_ids}")
+
+# Заблаговременное обновление сессии iCloud, чтобы запрос кода 2FA не пришёлся на синхронизацию
+@scheduler.task('cron', id='do_session_refresh', minute='15')
+def scheduled_session_refresh():
+    if not leader_lease.is_leader:
+        return
     with app.app_context():
-        app.logger.info("Starting scheduled sync")
-        sync_notes(db_service)
-        app.logger.info("Scheduled sync completed")
+        job_ids = sync_workers.enqueue_session_refreshes()
+        app.logger.info(f"Session refresh queued as jobs {job_ids}")
 
 
 if __name__ == "__main__":
+    logger.info(f"Server role: {SERVER_ROLE}")
     if IS_TEST_ENV:
         logger.info("Starting server in development mode...")
         app.run(host='0.0.0.0', port=8080, debug=True)
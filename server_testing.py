@@ -54,9 +54,9 @@ def test_accept_shared_folder():
         # Отправляем POST-запрос
         response = requests.post(url, headers=headers, json=data)
 
-        # Проверяем статус-код ответа
-        if response.status_code == 200:
-            print("Успешно принято приглашение в shared папку:")
+        # Проверяем статус-код ответа (202: приглашение принимается в фоне, статус по job_id)
+        if response.status_code in (200, 202):
+            print("Приглашение в shared папку поставлено в очередь:")
             print(response.json())
         else:
             print(f"Произошла ошибка: {response.status_code}")
@@ -1,71 +1,293 @@
-from notes_reader import authenticate_icloud, get_notes_list, accept_shared_folder
+from notes_reader import authenticate_icloud, get_notes_list, get_zone_snapshots, accept_shared_folder, setup_headers, get_zones, ICLOUD_ACCOUNTS, DEFAULT_ICLOUD_ACCOUNT
 from db_service import DatabaseService
 from embeddings_service import process_note
+from decrypt import get_decode_metrics
+from zone_scheduler import update_zone_schedules
+from leader_lease import LeaseLostError
+from collections import Counter
+import os
 import logging
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def sync_notes(db_service):
+# После стольких неудачных попыток заметка попадает в dead letters (skipped_notes) и больше не блокирует синхронизацию
+SYNC_MAX_NOTE_FAILURES = int(os.getenv('SYNC_MAX_NOTE_FAILURES', '3'))
+
+def check_fence(fence):
+    """Прерывает задачу, если её воркер больше не держит аренду лидера, под которой забрал задачу."""
+    if fence is not None:
+        fence.check()
+
+
+def build_chunk_documents(note, chunks):
+    """Формирует документы чанков заметки для сохранения в базу."""
+    chunk_documents = []
+    for i, (chunk_text, embeddings) in enumerate(chunks):
+        chunk_documents.append({
+            "title": f"{note['title']} - {i+1}" if len(chunks) > 1 else note['title'],
+            "text": chunk_text,
+            "embeddings": embeddings,
+            "record_id": f"{note['record_id']}-{i}" if len(chunks) > 1 else note['record_id'],
+            "created_date": note['created_date'],
+            "last_edited_date": note['last_edited_date'],
+            "folder_id": note['folder_id'],
+            "folder_name": note['folder_name'],
+            "owner_id": note['owner_id'],
+            "note_id": note['record_id'],
+            "zone_id": note['zone_id'],
+            "payload_hash": note['payload_hash']
+        })
+    return chunk_documents
+
+
+def sync_note(db_service, note, chunks=None):
+    """
+    Проводит заметку через этапы embedded -> written, сохраняя чекпоинт после каждого этапа.
+
+    :param chunks: Чанки с эмбеддингами из чекпоинта прошлого запуска, если они уже были посчитаны
+    """
+    # Текст не изменился: без повторного чанкинга и эмбеддингов обновляем только метаданные
+    if note['text_unchanged']:
+        db_service.update_note_metadata(note)
+        db_service.complete_note_checkpoint(note['record_id'])
+        logger.info(f"Updated metadata for unchanged note: {note['title']}")
+        return
+
+    if chunks is None:
+        # Эмбеддинги считаем с параметрами активного индекса
+        active_index = db_service.get_active_index()
+        chunks = process_note(note, active_index['embedding_model'], active_index['dimensions'], active_index['max_tokens'])
+        if any(embeddings is None for _, embeddings in chunks):
+            raise RuntimeError("Failed to create embeddings")
+        db_service.save_note_checkpoint_chunks(note['record_id'], note['zone_id'], chunks)
+    else:
+        logger.info(f"Resuming note from embedded checkpoint: {note['title']}")
+
+    chunk_documents = build_chunk_documents(note, chunks)
+    for i, chunk_data in enumerate(chunk_documents):
+        db_service.insert_or_update(chunk_data)
+        logger.info(f"Saved chunk {i+1} for note: {note['title']}")
+
+    # Заметка стала короче: удаляем лишние чанки прошлой версии
+    db_service.delete_stale_note_chunks(note['record_id'], [chunk_data['record_id'] for chunk_data in chunk_documents])
+    db_service.complete_note_checkpoint(note['record_id'])
+
+
+def apply_zone_snapshots(db_service, zone_snapshots, full_listing, purged_by_zone=None, account=DEFAULT_ICLOUD_ACCOUNT):
+    """
+    Удаляет из индекса заметки, удалённые в iCloud, а при полном списке зон — и зоны, к которым пропал доступ.
+
+    :param purged_by_zone: Если передан, в него записывается число удалённых чанков каждой зоны
+    :param account: Аккаунт iCloud, чей список зон получен
+    :return: Количество удалённых чанков
+    """
+    purged = 0
+    for zone_id, snapshot in zone_snapshots.items():
+        # Зону не удалось получить: ничего не удаляем
+        if snapshot is None:
+            continue
+        zone_purged = db_service.delete_notes(snapshot['deleted_note_ids'])
+        if snapshot['complete']:
+            zone_purged += db_service.delete_zone_notes_except(zone_id, snapshot['live_note_ids'])
+        if purged_by_zone is not None:
+            purged_by_zone[zone_id] = zone_purged
+        purged += zone_purged
+
+    # Пустой список зон скорее означает ошибку, чем потерю всех папок
+    if full_listing and zone_snapshots:
+        # В пуле аккаунтов список зон одного аккаунта не покрывает весь индекс: сверяем только его зоны
+        account_zone_ids = None
+        if len(ICLOUD_ACCOUNTS) > 1:
+            account_zone_ids = db_service.get_account_zone_ids(account, include_unassigned=account == DEFAULT_ICLOUD_ACCOUNT)
+        purged += db_service.delete_notes_outside_zones(zone_snapshots.keys(), account_zone_ids)
+
+    return purged
+
+
+def sync_notes(db_service, zone_ids=None, api=None, account=None, fence=None):
+    """
+    Синхронизирует заметки из shared зон аккаунта account (всех или только zone_ids).
+    Прогресс сохраняется в чекпоинтах, поэтому прерванная синхронизация продолжается с места остановки.
+
+    :param fence: Ограждение аренды лидера (LeaseFence); перед каждой записью проверяется, что аренда не перешла
+                  к другому процессу, иначе синхронизация прерывается с LeaseLostError
+
+    :return: Количество синхронизированных заметок или None, если синхронизация не удалась
+    """
+    account = account or DEFAULT_ICLOUD_ACCOUNT
+
     # Попытка загрузки существующей сессии
-    logger.info("Attempting to load existing session")
+    logger.info(f"Attempting to load existing session for {account}")
     
-    api = authenticate_icloud()
+    if api is None:
+        api = authenticate_icloud(account)
     
     if api:
         logger.info("Authentication successful")
         logger.info("Attempting to save new session")
     else:
         logger.error("Authentication failed")
-        return
+        return None
     
     try:
         # Получаем последние даты редактирования из базы данных
         synced_notes_edited_dates = db_service.get_last_edited_dates()
+        payload_hashes = db_service.get_payload_hashes()
+
+        # Незавершённые заметки прошлых запусков не запрашиваем заново, если они с тех пор не менялись.
+        # В пуле аккаунтов полная синхронизация берёт только чекпоинты зон своего аккаунта:
+        # заметки других зон параллельно дописывают их воркеры
+        checkpoint_zone_ids = zone_ids
+        if checkpoint_zone_ids is None and len(ICLOUD_ACCOUNTS) > 1:
+            checkpoint_zone_ids = db_service.get_account_zone_ids(account, include_unassigned=account == DEFAULT_ICLOUD_ACCOUNT)
+        pending_checkpoints = {checkpoint['record_id']: checkpoint for checkpoint in db_service.get_pending_note_checkpoints(checkpoint_zone_ids)}
+        for record_id, checkpoint in pending_checkpoints.items():
+            checkpoint_date = checkpoint['note']['last_edited_date']
+            if checkpoint_date > synced_notes_edited_dates.get(record_id, 0):
+                synced_notes_edited_dates[record_id] = checkpoint_date
+        if pending_checkpoints:
+            logger.info(f"Resuming {len(pending_checkpoints)} notes from previous sync checkpoints")
         
         # Передаем last_edited_dates в get_notes_list
-        notes = get_notes_list(api, synced_notes_edited_dates)
+        skipped_notes = []
+        zone_snapshots = {}
+        def save_zone_checkpoints(zone_notes):
+            # Заметки зоны сохраняются сразу после её загрузки: сбой на следующих зонах не теряет уже декодированные
+            check_fence(fence)
+            db_service.save_note_checkpoints(zone_notes, 'decoded')
+
+        notes = get_notes_list(api, synced_notes_edited_dates, skipped_notes, payload_hashes, zone_ids, zone_snapshots,
+                               on_zone_notes=save_zone_checkpoints)
         logger.info(f"Retrieved {len(notes)} updated notes from iCloud")
 
+        # Слишком большие и недекодируемые заметки сохраняем как пропущенные, не прерывая синхронизацию
+        if skipped_notes:
+            logger.warning(f"Skipped {len(skipped_notes)} notes during sync")
+            db_service.record_skipped_notes(skipped_notes)
+        logger.info(f"Decode metrics: {get_decode_metrics()}")
+
+        # Свежие версии заметок заменяют чекпоинты прошлых запусков
+        work = [(note, None) for note in notes]
         for note in notes:
-            chunks = process_note(note)
-            
-            for i, (chunk_text, embeddings) in enumerate(chunks):
-                chunk_data = {
-                    "title": f"{note['title']} - {i+1}" if len(chunks) > 1 else note['title'],
-                    "text": chunk_text,
-                    "embeddings": embeddings,
-                    "record_id": f"{note['record_id']}-{i}" if len(chunks) > 1 else note['record_id'],
-                    "created_date": note['created_date'],
-                    "last_edited_date": note['last_edited_date'],
-                    "folder_id": note['folder_id'],
-                    "folder_name": note['folder_name'],
-                    "owner_id": note['owner_id']
-                }
-                
-                db_service.insert_or_update(chunk_data)
-                logger.info(f"Saved chunk {i+1} for note: {note['title']}")
-
-        logger.info("Synchronization completed successfully")
+            pending_checkpoints.pop(note['record_id'], None)
+        for checkpoint in pending_checkpoints.values():
+            work.append((checkpoint['note'], checkpoint.get('chunks') if checkpoint['stage'] == 'embedded' else None))
+
+        zone_progress = {}
+        for note, _ in work:
+            progress = zone_progress.setdefault(note['zone_id'], {'notes_total': 0, 'notes_written': 0, 'notes_failed': 0})
+            progress['notes_total'] += 1
+        for zone_id, progress in zone_progress.items():
+            db_service.update_zone_sync_progress(zone_id, 'in_progress', progress, account)
+
+        for note, chunks in work:
+            progress = zone_progress[note['zone_id']]
+            check_fence(fence)
+            try:
+                sync_note(db_service, note, chunks)
+                progress['notes_written'] += 1
+            except Exception as e:
+                # Ошибка одной заметки не прерывает синхронизацию остальных
+                logger.error(f"Failed to sync note {note['record_id']}: {e}")
+                progress['notes_failed'] += 1
+                failures = db_service.record_note_checkpoint_failure(note['record_id'], str(e))
+                if failures >= SYNC_MAX_NOTE_FAILURES:
+                    logger.error(f"Note {note['record_id']} failed {failures} times, moving it to dead letters")
+                    db_service.record_skipped_notes([{
+                        'record_id': note['record_id'],
+                        'zone_id': note['zone_id'],
+                        'reason': 'too_many_failures',
+                        'last_error': str(e),
+                        'last_edited_date': note['last_edited_date']
+                    }])
+                    db_service.complete_note_checkpoint(note['record_id'])
+
+        check_fence(fence)
+        for zone_id, progress in zone_progress.items():
+            status = 'completed' if not progress['notes_failed'] else 'completed_with_errors'
+            db_service.update_zone_sync_progress(zone_id, status, progress, account)
 
+        # Удалённые заметки и потерянные зоны убираем из индекса после записи новых
+        check_fence(fence)
+        purged_by_zone = {}
+        purged = apply_zone_snapshots(db_service, zone_snapshots, full_listing=zone_ids is None, purged_by_zone=purged_by_zone, account=account)
+        logger.info(f"Purged {purged} dead chunks from the index")
+
+        # Зоны с изменениями опрашиваются чаще, тихие — реже
+        changes_by_zone = Counter(note['zone_id'] for note in notes)
+        changes_by_zone.update(skipped['zone_id'] for skipped in skipped_notes)
+        changes_by_zone.update(purged_by_zone)
+        update_zone_schedules(db_service, [zone_id for zone_id, snapshot in zone_snapshots.items() if snapshot is not None], changes_by_zone, account)
+
+        synced_count = sum(progress['notes_written'] for progress in zone_progress.values())
+        logger.info(f"Synchronization completed: {synced_count} of {len(work)} notes synced")
+        return synced_count
+
+    except LeaseLostError:
+        # Задачу выполнит новый лидер, результат этого запуска не записываем
+        raise
     except Exception as e:
         logger.error(f"An error occurred during synchronization: {e}")
+        return None
+
+def reconcile_notes(db_service, api=None, account=None, fence=None):
+    """
+    Сверяет индекс с текущим состоянием зон аккаунта account без загрузки содержимого заметок.
+
+    :return: Количество удалённых чанков или None, если сверка не удалась
+    """
+    account = account or DEFAULT_ICLOUD_ACCOUNT
+    if api is None:
+        api = authenticate_icloud(account)
+    if not api:
+        logger.error("Authentication failed, unable to reconcile notes")
+        return None
 
-def accept_invite(db_service, short_guid):
-    logger.info(f"Attempting to accept invite for shared folder with shortGUID: {short_guid}")
+    zone_snapshots = get_zone_snapshots(api)
+    if zone_snapshots is None:
+        return None
+
+    check_fence(fence)
+    purged = apply_zone_snapshots(db_service, zone_snapshots, full_listing=True, account=account)
+    logger.info(f"Reconciliation completed: purged {purged} dead chunks")
+    return purged
+
+def accept_invite(db_service, short_guid, account=None, fence=None):
+    """
+    Принимает приглашение в shared папку аккаунтом account и синхронизирует только появившиеся после этого зоны.
+    Новые зоны закрепляются за этим аккаунтом.
+
+    :return: Количество синхронизированных заметок или None, если принять приглашение не удалось
+    """
+    account = account or DEFAULT_ICLOUD_ACCOUNT
+    logger.info(f"Attempting to accept invite for shared folder with shortGUID: {short_guid} as {account}")
     
     # Попытка загрузки существующей сессии
-    api = authenticate_icloud()
+    api = authenticate_icloud(account)
     
-    if api:
-        logger.info("Authentication successful")
-        result = accept_shared_folder(api, short_guid)
-        if result:
-            logger.info(f"Successfully accepted shared folder with shortGUID: {short_guid}")
-            # Здесь можно добавить дополнительную логику, например, немедленную синхронизацию новой папки
-            sync_notes(db_service)
-        else:
-            logger.error(f"Failed to accept shared folder with shortGUID: {short_guid}")
-    else:
-        logger.error("Authentication failed, unable to accept invite")
\ No newline at end of file
+    if not api:
+        logger.error("Authentication failed, unable to accept invite")
+        return None
+
+    logger.info("Authentication successful")
+    headers, params = setup_headers(api)
+    zones_before = {zone['zoneID']['zoneName'] for zone in get_zones(params['dsid'], headers)}
+
+    check_fence(fence)
+    result = accept_shared_folder(api, short_guid)
+    if not result:
+        logger.error(f"Failed to accept shared folder with shortGUID: {short_guid}")
+        return None
+
+    logger.info(f"Successfully accepted shared folder with shortGUID: {short_guid}")
+
+    # Синхронизируем только новую папку, а не все зоны
+    zones_after = {zone['zoneID']['zoneName'] for zone in get_zones(params['dsid'], headers)}
+    new_zone_ids = sorted(zones_after - zones_before)
+    if not new_zone_ids:
+        logger.info(f"No new zones after accepting shortGUID: {short_guid}, folder is already synced")
+        return 0
+
+    return sync_notes(db_service, zone_ids=new_zone_ids, api=api, account=account, fence=fence)
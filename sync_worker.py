@@ -0,0 +1,203 @@
+import os
+import logging
+import threading
+from sync_notes import sync_notes, accept_invite, reconcile_notes
+from notes_reader import authenticate_icloud, ICLOUD_ACCOUNTS
+from leader_lease import LeaseLostError
+
+logger = logging.getLogger(__name__)
+
+# Как часто воркер проверяет очередь, если его не разбудили явно (в секундах)
+SYNC_WORKER_POLL_INTERVAL = float(os.getenv('SYNC_WORKER_POLL_INTERVAL', '30'))
+
+
+class SyncWorker:
+    """
+    Выполняет задачи синхронизации одного аккаунта iCloud из очереди sync_jobs (MongoDB) в отдельном потоке,
+    по одной за раз. Повторные запросы одной и той же синхронизации объединяются в одну задачу.
+    """
+
+    def __init__(self, db_service, account, default=False, lease=None):
+        """
+        :param default: Воркер выполняет и задачи без аккаунта, поставленные до появления пула аккаунтов
+        :param lease: Аренда лидера (LeaderLease): задачи забираются только под ней и помечаются её эпохой,
+                      а выполнение прерывается, как только аренда перешла к другому процессу
+        """
+        self.db_service = db_service
+        self.account = account
+        self.lease = lease
+        self.accounts = [account, None] if default else [account]
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # Задачи прежних эпох аренды возвращаем в очередь: их воркер прервётся на ближайшей проверке аренды
+        self.db_service.requeue_running_sync_jobs(self.accounts, self.lease.epoch if self.lease else None)
+        if self.thread and self.thread.is_alive():
+            # Остановка без ожидания ещё не завершилась: поток продолжает работу
+            self.stop_event.clear()
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name=f'sync-worker-{self.account}', daemon=True)
+        self.thread.start()
+        logger.info(f"Sync worker for {self.account} started")
+
+    def stop(self, wait=True):
+        """Останавливает воркер после текущей задачи. С wait=False не ждёт её завершения."""
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread and wait:
+            self.thread.join()
+        logger.info(f"Sync worker for {self.account} stopped")
+
+    def enqueue_sync(self, zone_ids=None):
+        """Ставит в очередь синхронизацию всех зон или только zone_ids."""
+        if zone_ids:
+            # Ожидающая полная синхронизация уже покрывает эти зоны
+            full_sync_job_id = self.db_service.find_pending_sync_job(f"{self.account}:sync:all")
+            if full_sync_job_id:
+                return full_sync_job_id
+            zone_ids = sorted(zone_ids)
+            dedupe_key = f"{self.account}:sync:{','.join(zone_ids)}"
+        else:
+            zone_ids = None
+            dedupe_key = f"{self.account}:sync:all"
+
+        job_id = self.db_service.enqueue_sync_job('sync', {'zone_ids': zone_ids}, dedupe_key, self.account)
+        self.wake_event.set()
+        return job_id
+
+    def enqueue_accept_invite(self, short_guid, owner_id=None):
+        """Ставит в очередь принятие приглашения в shared папку и синхронизацию этой папки от имени owner_id."""
+        # Ключ без аккаунта: одно приглашение не должны принимать два аккаунта.
+        # Владелец в ключе: повторный запрос другого владельца не получает чужую задачу
+        job_id = self.db_service.enqueue_sync_job(
+            'accept_invite', {'short_guid': short_guid}, f"accept:{owner_id}:{short_guid}", self.account, owner_id
+        )
+        self.wake_event.set()
+        return job_id
+
+    def enqueue_reconcile(self):
+        """Ставит в очередь сверку индекса с iCloud (удаление мёртвых заметок и зон)."""
+        job_id = self.db_service.enqueue_sync_job('reconcile', {}, f"{self.account}:reconcile", self.account)
+        self.wake_event.set()
+        return job_id
+
+    def enqueue_session_refresh(self):
+        """Ставит в очередь проверку сессии iCloud; если она скоро истечёт, сессия обновляется."""
+        job_id = self.db_service.enqueue_sync_job('refresh_session', {}, f"{self.account}:refresh_session", self.account)
+        self.wake_event.set()
+        return job_id
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            fence = self.lease.fence() if self.lease else None
+            job = None
+            if self.lease is None or fence is not None:
+                try:
+                    job = self.db_service.claim_sync_job(
+                        self.accounts,
+                        worker_id=fence.holder if fence else None,
+                        lease_epoch=fence.epoch if fence else None
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to claim sync job: {e}")
+
+            if job is None:
+                self.wake_event.wait(SYNC_WORKER_POLL_INTERVAL)
+                self.wake_event.clear()
+                continue
+
+            self._execute(job, fence)
+
+    def _execute(self, job, fence=None):
+        job_id = job['_id']
+        lease_epoch = fence.epoch if fence else None
+        logger.info(f"Starting sync job {job_id} ({job['dedupe_key']})")
+
+        try:
+            if job['type'] == 'accept_invite':
+                result = accept_invite(self.db_service, job['params']['short_guid'], self.account, fence)
+                result_key = 'synced_notes'
+            elif job['type'] == 'refresh_session':
+                result = True if authenticate_icloud(self.account) else None
+                result_key = 'authenticated'
+            elif job['type'] == 'reconcile':
+                result = reconcile_notes(self.db_service, account=self.account, fence=fence)
+                result_key = 'purged_chunks'
+            else:
+                result = sync_notes(self.db_service, zone_ids=job['params'].get('zone_ids'), account=self.account, fence=fence)
+                result_key = 'synced_notes'
+
+            if result is None:
+                self.db_service.finish_sync_job(job_id, 'failed', error='Synchronization failed, see server logs', lease_epoch=lease_epoch)
+                logger.error(f"Sync job {job_id} failed")
+            else:
+                self.db_service.finish_sync_job(job_id, 'completed', result={result_key: result}, lease_epoch=lease_epoch)
+                logger.info(f"Sync job {job_id} completed")
+
+        except LeaseLostError as e:
+            # Задачу вернул в очередь и выполнит новый лидер
+            logger.warning(f"Sync job {job_id} abandoned: {e}")
+        except Exception as e:
+            logger.exception(f"Sync job {job_id} failed: {e}")
+            self.db_service.finish_sync_job(job_id, 'failed', error=str(e), lease_epoch=lease_epoch)
+
+
+class SyncWorkerPool:
+    """
+    Воркеры всех принимающих аккаунтов iCloud. У каждого аккаунта своя сессия, лимит CloudKit и очередь задач,
+    поэтому пропускная способность синхронизации растёт с числом аккаунтов.
+    Зона закреплена за аккаунтом, который принял приглашение в неё (sync_zones.account).
+    """
+
+    def __init__(self, db_service, accounts=None, lease=None):
+        accounts = accounts or [account['username'] for account in ICLOUD_ACCOUNTS]
+        self.db_service = db_service
+        self.default_account = accounts[0]
+        self.workers = {
+            account: SyncWorker(db_service, account, default=index == 0, lease=lease)
+            for index, account in enumerate(accounts)
+        }
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+
+    def stop(self, wait=True):
+        for worker in self.workers.values():
+            worker.stop(wait)
+
+    def worker(self, account=None):
+        """Воркер аккаунта; зоны без аккаунта и неизвестные аккаунты обслуживает аккаунт по умолчанию."""
+        return self.workers.get(account) or self.workers[self.default_account]
+
+    def least_loaded_account(self):
+        """Аккаунт с наименьшим числом зон, считая приглашения, которые ещё принимаются."""
+        zones = self.db_service.count_zones_by_account()
+        invites = self.db_service.count_pending_sync_jobs_by_account('accept_invite')
+        load = {account: zones.get(account, 0) + invites.get(account, 0) for account in self.workers}
+        load[self.default_account] += zones.get(None, 0) + invites.get(None, 0)
+        return min(self.workers, key=lambda account: load[account])
+
+    def enqueue_accept_invite(self, short_guid, owner_id=None):
+        account = self.least_loaded_account()
+        logger.info(f"Routing invite {short_guid} to {account}")
+        return self.worker(account).enqueue_accept_invite(short_guid, owner_id)
+
+    def enqueue_zone_syncs(self, zones):
+        """Ставит в очередь синхронизацию зон, по одной задаче на аккаунт. zones — пары (zone_id, аккаунт)."""
+        zone_ids_by_account = {}
+        for zone_id, account in zones:
+            zone_ids_by_account.setdefault(self.worker(account).account, []).append(zone_id)
+        return [self.workers[account].enqueue_sync(zone_ids) for account, zone_ids in zone_ids_by_account.items()]
+
+    def enqueue_full_syncs(self):
+        return [worker.enqueue_sync() for worker in self.workers.values()]
+
+    def enqueue_reconciles(self):
+        return [worker.enqueue_reconcile() for worker in self.workers.values()]
+
+    def enqueue_session_refreshes(self):
+        return [worker.enqueue_session_refresh() for worker in self.workers.values()]
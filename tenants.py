@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Ограничения владельца по умолчанию; в документе ключа api_keys их можно переопределить
+TENANT_MAX_RPS = float(os.getenv('TENANT_MAX_RPS', '5'))
+TENANT_MAX_CONCURRENT_SEARCHES = int(os.getenv('TENANT_MAX_CONCURRENT_SEARCHES', '2'))
+# Сколько секунд помним владельца ключа, прежде чем перечитать его из базы
+API_KEY_CACHE_SECONDS = float(os.getenv('API_KEY_CACHE_SECONDS', '60'))
+
+
+def hash_api_key(api_key):
+    """В базе хранится только хэш ключа."""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+class TenantLimits:
+    """Ограничения одного владельца: частота запросов (token bucket) и число одновременных поисков."""
+
+    def __init__(self, max_rps, max_concurrent):
+        self.max_rps = max_rps
+        self.max_concurrent = max_concurrent
+        self.loaded_at = time.monotonic()
+        self.burst = max(1.0, max_rps)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(1, max_concurrent))
+
+    def try_acquire(self):
+        """
+        Занимает слот без ожидания, чтобы запросы одного владельца не занимали потоки сервера.
+
+        :return: None, если запрос можно выполнять (после него нужно вызвать release()), иначе причина отказа
+        """
+        if self.max_rps > 0:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.max_rps)
+                self.updated_at = now
+                if self.tokens < 1:
+                    return 'Rate limit exceeded'
+                self.tokens -= 1
+        if not self.slots.acquire(blocking=False):
+            return 'Too many concurrent requests'
+        return None
+
+    def release(self):
+        self.slots.release()
+
+
+class TenantRegistry:
+    """
+    Определяет владельца заметок по ключу API и хранит ограничения каждого владельца.
+    Ключ legacy_api_key (GPTS_API_KEY) относится к legacy_owner_id, остальные ключи берутся из коллекции api_keys.
+    """
+
+    def __init__(self, db_service, legacy_api_key=None, legacy_owner_id=None):
+        self.db_service = db_service
+        self.legacy_api_key = legacy_api_key
+        self.legacy_owner_id = legacy_owner_id
+        self.lock = threading.Lock()
+        self.tenants = {}
+        self.limits = {}
+
+    def resolve(self, api_key):
+        """
+        :return: Описание владельца ({'owner_id': ..., необязательные max_rps и max_concurrent_searches})
+                 или None, если ключ неизвестен
+        """
+        if not api_key:
+            return None
+        tenant, key_hash = self._cached_tenant(api_key)
+        if key_hash is None:
+            return tenant
+        return self._remember(key_hash, self.db_service.get_api_key(key_hash))
+
+    async def resolve_async(self, api_key):
+        """Асинхронный вариант resolve: ключ, которого нет в кэше, читается асинхронным клиентом."""
+        if not api_key:
+            return None
+        tenant, key_hash = self._cached_tenant(api_key)
+        if key_hash is None:
+            return tenant
+        return self._remember(key_hash, await self.db_service.get_api_key_async(key_hash))
+
+    def _cached_tenant(self, api_key):
+        """
+        :return: (владелец, None), если ключ известен без обращения к базе, иначе (None, хэш ключа)
+        """
+        if self.legacy_api_key and self.legacy_owner_id and hmac.compare_digest(api_key.encode('utf-8'), self.legacy_api_key.encode('utf-8')):
+            return {'owner_id': self.legacy_owner_id}, None
+
+        key_hash = hash_api_key(api_key)
+        cached = self.tenants.get(key_hash)
+        if cached and time.monotonic() - cached[1] < API_KEY_CACHE_SECONDS:
+            return cached[0], None
+        return None, key_hash
+
+    def _remember(self, key_hash, tenant):
+        # Неизвестные ключи не кэшируем, чтобы перебор ключей не занимал память
+        if tenant and not tenant.get('disabled'):
+            with self.lock:
+                self.tenants[key_hash] = (tenant, time.monotonic())
+            return tenant
+        with self.lock:
+            self.tenants.pop(key_hash, None)
+        return None
+
+    def limits_for(self, tenant):
+        """
+        Ограничения владельца. Раз в API_KEY_CACHE_SECONDS они сверяются с настройками ключа,
+        и изменённые max_rps или max_concurrent_searches начинают действовать.
+        """
+        owner_id = tenant['owner_id']
+        max_rps = tenant.get('max_rps', TENANT_MAX_RPS)
+        max_concurrent = tenant.get('max_concurrent_searches', TENANT_MAX_CONCURRENT_SEARCHES)
+        with self.lock:
+            limits = self.limits.get(owner_id)
+            if limits is not None and time.monotonic() - limits.loaded_at >= API_KEY_CACHE_SECONDS:
+                if (limits.max_rps, limits.max_concurrent) == (max_rps, max_concurrent):
+                    limits.loaded_at = time.monotonic()
+                else:
+                    # Запросы, занявшие слот прежних ограничений, освобождают его в прежнем объекте
+                    limits = None
+            if limits is None:
+                limits = TenantLimits(max_rps, max_concurrent)
+                self.limits[owner_id] = limits
+        return limits
+
+
+if __name__ == "__main__":
+    from db_service import DatabaseService
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Manage per-owner API keys")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = subparsers.add_parser('add-key', help="Create an API key for an owner and print it")
+    add_parser.add_argument('--owner', required=True, help="Owner record name (owner_id of the notes)")
+    add_parser.add_argument('--name', help="Human-readable label")
+    add_parser.add_argument('--max-rps', type=float, help="Search requests per second")
+    add_parser.add_argument('--max-concurrent', type=int, help="Concurrent searches")
+
+    revoke_parser = subparsers.add_parser('revoke-key', help="Disable an API key")
+    revoke_parser.add_argument('api_key')
+
+    args = parser.parse_args()
+    db_service = DatabaseService()
+
+    if args.command == 'add-key':
+        api_key = secrets.token_urlsafe(32)
+        limits = {}
+        if args.max_rps is not None:
+            limits['max_rps'] = args.max_rps
+        if args.max_concurrent is not None:
+            limits['max_concurrent_searches'] = args.max_concurrent
+        db_service.save_api_key(hash_api_key(api_key), args.owner, args.name, **limits)
+        print(f"API key for {args.owner}: {api_key}")
+    else:
+        db_service.disable_api_key(hash_api_key(args.api_key))
+        print("API key disabled")
+
+    db_service.close_connection()
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import mongomock
+import pytest
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class WordEncoding:
+    """Кодировщик без загрузки словаря tiktoken: один токен — одно слово."""
+
+    def encode(self, text, **kwargs):
+        return text.split(' ')
+
+    def decode(self, tokens):
+        return ' '.join(tokens)
+
+
+tiktoken.get_encoding = lambda name: WordEncoding()
+tiktoken.encoding_for_model = lambda model: WordEncoding()
+
+
+@pytest.fixture
+def db_service():
+    """DatabaseService без подключения: коллекции заменены на mongomock."""
+    from db_service import DatabaseService
+    service = DatabaseService.__new__(DatabaseService)
+    db = mongomock.MongoClient()['apple-notes']
+    service.db = db
+    service.get_active_index = lambda: {'collection': 'notes'}
+    service.skipped_notes_collection = db['skipped_notes']
+    service.sync_checkpoints_collection = db['sync_checkpoints']
+    service.sync_checkpoint_chunks_collection = db['sync_checkpoint_chunks']
+    return service
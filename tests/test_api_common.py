@@ -0,0 +1,23 @@
+import pytest
+
+from api_common import parse_search_request
+from search_response import SEARCH_RESPONSE_MIN_TOKEN_BUDGET, SEARCH_RESPONSE_TOKEN_BUDGET
+
+
+@pytest.mark.parametrize('max_response_tokens', [0, -100])
+def test_non_positive_response_budget_is_rejected(max_response_tokens):
+    params, error = parse_search_request({'search_query': 'notes', 'max_response_tokens': max_response_tokens})
+
+    assert params is None
+    assert 'max_response_tokens' in error
+
+
+@pytest.mark.parametrize('max_response_tokens, expected', [
+    (1, SEARCH_RESPONSE_MIN_TOKEN_BUDGET),
+    (SEARCH_RESPONSE_TOKEN_BUDGET * 10, SEARCH_RESPONSE_TOKEN_BUDGET),
+])
+def test_response_budget_is_clamped(max_response_tokens, expected):
+    params, error = parse_search_request({'search_query': 'notes', 'max_response_tokens': max_response_tokens})
+
+    assert error is None
+    assert params['token_budget'] == expected
@@ -0,0 +1,42 @@
+from pymongo.errors import PyMongoError
+
+import auth_broker as auth_broker_module
+from auth_broker import AuthBroker
+
+
+class FailingStream:
+    closed = False
+
+    def try_next(self):
+        raise PyMongoError('change stream invalidated')
+
+    def close(self):
+        self.closed = True
+
+
+class CodeStore:
+    """Код появляется в базе после нескольких проверок, а change stream ломается на первом ожидании."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.checks = 0
+
+    def request_auth_code(self, account):
+        pass
+
+    def watch_auth_code(self, account):
+        return self.stream
+
+    def take_auth_code(self, account):
+        self.checks += 1
+        return '123456' if self.checks >= 3 else None
+
+
+def test_failed_change_stream_falls_back_to_polling(monkeypatch):
+    monkeypatch.setattr(auth_broker_module, 'AUTH_CODE_CHECK_INTERVAL', 0.01)
+    stream = FailingStream()
+    broker = AuthBroker()
+    broker.attach(CodeStore(stream))
+
+    assert broker.wait_for_code('user@example.com', timeout=5) == '123456'
+    assert stream.closed
@@ -0,0 +1,28 @@
+def test_skipped_note_date_wins_over_older_chunks(db_service):
+    # Заметка была проиндексирована, а после правки стала слишком большой и пропускается
+    db_service.notes_collection.insert_many([
+        {'record_id': 'note-a-0', 'note_id': 'note-a', 'last_edited_date': 100},
+        {'record_id': 'note-a-1', 'note_id': 'note-a', 'last_edited_date': 100},
+        {'record_id': 'note-b-0', 'note_id': 'note-b', 'last_edited_date': 300},
+    ])
+    db_service.record_skipped_notes([
+        {'record_id': 'note-a', 'zone_id': 'zone', 'reason': 'too_large', 'last_edited_date': 200},
+        # Пропуск старой версии не откатывает дату проиндексированной новой
+        {'record_id': 'note-b', 'zone_id': 'zone', 'reason': 'too_large', 'last_edited_date': 250},
+        {'record_id': 'note-c', 'zone_id': 'zone', 'reason': 'decode_failed', 'last_edited_date': 50},
+    ])
+
+    assert db_service.get_last_edited_dates() == {'note-a': 200, 'note-b': 300, 'note-c': 50}
+
+
+def test_oversized_note_is_not_checkpointed(db_service, monkeypatch):
+    import db_service as db_module
+    monkeypatch.setattr(db_module, 'SYNC_CHECKPOINT_NOTE_MAX_BYTES', 1024)
+    # Прежняя версия заметки успела попасть в чекпоинт вместе с чанками
+    db_service.sync_checkpoints_collection.insert_one({'record_id': 'big', 'zone_id': 'zone', 'stage': 'embedded', 'chunk_count': 1})
+    db_service.sync_checkpoint_chunks_collection.insert_one({'record_id': 'big', 'zone_id': 'zone', 'index': 0, 'text': 'old'})
+
+    db_service.save_note_checkpoints([{'record_id': 'big', 'zone_id': 'zone', 'text': 'x' * 2048}], 'decoded')
+
+    assert db_service.sync_checkpoints_collection.count_documents({}) == 0
+    assert db_service.sync_checkpoint_chunks_collection.count_documents({}) == 0
@@ -0,0 +1,46 @@
+import pytest
+
+import notes_reader
+from leader_lease import LeaseLostError
+
+
+@pytest.fixture
+def zones(monkeypatch):
+    zones = [{'zoneID': {'zoneName': 'zone-a'}}, {'zoneID': {'zoneName': 'zone-b'}}]
+    monkeypatch.setattr(notes_reader, 'list_shared_zones', lambda api, zone_ids: (zones, 'dsid', {}))
+    monkeypatch.setattr(notes_reader, 'get_zone_notes', lambda zone, *args: [{'record_id': zone['zoneID']['zoneName']}])
+    return zones
+
+
+def test_checkpoint_error_keeps_zone_notes(zones):
+    def on_zone_notes(zone_notes):
+        if zone_notes[0]['record_id'] == 'zone-a':
+            raise RuntimeError('write failed')
+
+    notes = notes_reader.get_notes_list(None, {}, on_zone_notes=on_zone_notes)
+
+    assert sorted(note['record_id'] for note in notes) == ['zone-a', 'zone-b']
+
+
+def test_lost_lease_stops_listing(zones):
+    def on_zone_notes(zone_notes):
+        raise LeaseLostError('lease moved')
+
+    with pytest.raises(LeaseLostError):
+        notes_reader.get_notes_list(None, {}, on_zone_notes=on_zone_notes)
+
+
+def test_unexpected_auth_error_resets_session(monkeypatch):
+    class BrokenSession:
+        requires_2fa = False
+
+        def authenticate(self, force_refresh=False):
+            raise ConnectionError('iCloud is unreachable')
+
+    session = notes_reader._get_icloud_session('broken@example.com')
+    session['api'] = BrokenSession()
+    session['refreshed_at'] = 0
+    monkeypatch.setattr(notes_reader, 'session_refresh_due', lambda refreshed_at, api: True)
+
+    assert notes_reader.authenticate_icloud('broken@example.com') is None
+    assert session['api'] is None
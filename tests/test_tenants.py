@@ -0,0 +1,13 @@
+from tenants import TenantRegistry
+
+
+class NoKeys:
+    def get_api_key(self, key_hash):
+        return None
+
+
+def test_non_ascii_key_is_unknown_not_an_error():
+    registry = TenantRegistry(NoKeys(), 'legacy-key', 'owner')
+
+    assert registry.resolve('ключ-не-ascii') is None
+    assert registry.resolve('legacy-key') == {'owner_id': 'owner'}
@@ -0,0 +1,76 @@
+import os
+import time
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Границы интервала опроса зоны (в секундах): зона с правками опрашивается раз в ZONE_SYNC_MIN_INTERVAL,
+# после каждого опроса без изменений интервал растёт до ZONE_SYNC_MAX_INTERVAL
+ZONE_SYNC_MIN_INTERVAL = float(os.getenv('ZONE_SYNC_MIN_INTERVAL', str(5 * 60)))
+ZONE_SYNC_MAX_INTERVAL = float(os.getenv('ZONE_SYNC_MAX_INTERVAL', str(6 * 60 * 60)))
+ZONE_SYNC_BACKOFF = 2.0
+# Вес последнего опроса в скользящей доле опросов с изменениями
+ZONE_CHANGE_RATE_ALPHA = 0.3
+# Случайный разброс времени следующего опроса, чтобы зоны не синхронизировались одновременно
+ZONE_SYNC_JITTER = 0.1
+# Сколько зон ставим в одну задачу синхронизации и на сколько секунд резервируем их за задачей
+ZONE_SYNC_BATCH_SIZE = int(os.getenv('ZONE_SYNC_BATCH_SIZE', '10'))
+ZONE_SYNC_CLAIM_SECONDS = 30 * 60
+
+
+def next_poll_interval(interval, changed, change_rate):
+    """
+    Зона с изменениями сразу возвращается к минимальному интервалу. Без изменений интервал растёт,
+    тем медленнее, чем чаще зона менялась раньше.
+    """
+    if changed:
+        return ZONE_SYNC_MIN_INTERVAL
+    growth = 1 + (ZONE_SYNC_BACKOFF - 1) * (1 - change_rate)
+    return min(ZONE_SYNC_MAX_INTERVAL, max(ZONE_SYNC_MIN_INTERVAL, interval * growth))
+
+
+def update_zone_schedules(db_service, zone_ids, changes_by_zone, account=None):
+    """
+    Пересчитывает расписание опрошенных зон по числу изменений, найденных в каждой из них.
+
+    :param zone_ids: Зоны, которые удалось опросить
+    :param changes_by_zone: zone_id -> число изменённых, пропущенных и удалённых заметок
+    :param account: Аккаунт iCloud, через который зоны опрошены; за ним они и закрепляются
+    """
+    if not zone_ids:
+        return
+    now = time.time()
+    schedules = db_service.get_zone_schedules(zone_ids)
+
+    updates = []
+    for zone_id in zone_ids:
+        schedule = schedules.get(zone_id, {})
+        changed = changes_by_zone.get(zone_id, 0) > 0
+        change_rate = (1 - ZONE_CHANGE_RATE_ALPHA) * schedule.get('change_rate', 0) + ZONE_CHANGE_RATE_ALPHA * changed
+        interval = next_poll_interval(schedule.get('poll_interval', ZONE_SYNC_MIN_INTERVAL), changed, change_rate)
+        delay = interval * random.uniform(1 - ZONE_SYNC_JITTER, 1 + ZONE_SYNC_JITTER)
+
+        update = {
+            'zone_id': zone_id,
+            'account': account,
+            'poll_interval': interval,
+            'change_rate': change_rate,
+            'last_polled_at': int(now * 1000),
+            'next_sync_at': int((now + delay) * 1000)
+        }
+        if changed:
+            update['last_changed_at'] = int(now * 1000)
+        updates.append(update)
+
+    db_service.save_zone_schedules(updates)
+    logger.info(f"Rescheduled {len(updates)} zones, {sum(1 for zone_id in zone_ids if changes_by_zone.get(zone_id))} with changes")
+
+
+def claim_due_zones(db_service):
+    """
+    Зоны, которым пора синхронизироваться: сначала самые просроченные, не больше ZONE_SYNC_BATCH_SIZE.
+
+    :return: Список пар (zone_id, аккаунт)
+    """
+    return db_service.claim_due_zones(ZONE_SYNC_BATCH_SIZE, ZONE_SYNC_CLAIM_SECONDS)